@@ -0,0 +1,85 @@
+import random
+import asyncio
+import zlib
+from aiohttp import web
+
+GENRES = ["драма", "комедия", "боевик", "триллер", "фантастика", "мелодрама", "ужасы", "мультфильм"]
+COUNTRIES = ["США", "Россия", "Франция", "Великобритания", "Япония"]
+
+
+class FakeKinopoiskServer:
+    # Подмена api.kinopoisk.dev с детерминированным каталогом,
+    # настраиваемой задержкой и долей ошибок (500/429)
+    def __init__(self, latency=0.05, jitter=0.5, error_rate=0.0, catalog_size=1000, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.catalog_size = catalog_size
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+    def _film(self, film_id):
+        rnd = random.Random(film_id)
+        return {
+            "id": film_id,
+            "name": f"Фильм {film_id}",
+            "year": rnd.randint(1950, 2024),
+            "description": "Описание фильма " * rnd.randint(5, 40),
+            "genres": [{"name": name} for name in rnd.sample(GENRES, 2)],
+            "countries": [{"name": rnd.choice(COUNTRIES)}],
+            "persons": [{"name": f"Режиссёр {rnd.randint(1, 200)}", "profession": "режиссеры"}]
+            + [{"name": f"Актёр {rnd.randint(1, 3000)}", "profession": "актеры"} for _ in range(8)],
+            "rating": {"kp": round(rnd.uniform(4, 9), 1)},
+            "poster": {"url": f"https://example.com/poster/{film_id}.jpg"},
+            "videos": {"trailers": [{"url": f"https://example.com/trailer/{film_id}"}]},
+            "watchability": {"items": [{"url": f"https://example.com/watch/{film_id}"}]},
+        }
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(max(0.0, self.random.gauss(self.latency, self.latency * self.jitter)))
+
+    def _error(self):
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            status = self.random.choice([429, 500, 503])
+            return web.Response(status=status, headers={"Retry-After": "1"} if status == 429 else None)
+        return None
+
+    async def _search(self, request: web.Request):
+        self.requests += 1
+        await self._delay()
+        error = self._error()
+        if error is not None:
+            return error
+        query = request.query.get("query", "")
+        limit = int(request.query.get("limit", "5"))
+        first = zlib.crc32(query.encode()) % self.catalog_size + 1
+        docs = [self._film((first + i - 1) % self.catalog_size + 1) for i in range(limit)]
+        return web.json_response({"docs": docs, "total": len(docs), "limit": limit, "page": 1, "pages": 1})
+
+    async def _movie(self, request: web.Request):
+        self.requests += 1
+        await self._delay()
+        error = self._error()
+        if error is not None:
+            return error
+        return web.json_response(self._film(int(request.match_info["film_id"])))
+
+    async def _movies(self, request: web.Request):
+        # GET /movie?id=1&id=2 — несколько фильмов одним запросом
+        self.requests += 1
+        await self._delay()
+        error = self._error()
+        if error is not None:
+            return error
+        docs = [self._film(int(film_id)) for film_id in request.query.getall("id", [])]
+        return web.json_response({"docs": docs, "total": len(docs), "limit": len(docs), "page": 1, "pages": 1})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/v1.4/movie", self._movies)
+        app.router.add_get("/v1.4/movie/search", self._search)
+        app.router.add_get("/v1.4/movie/{film_id:\\d+}", self._movie)
+        return app
@@ -0,0 +1,122 @@
+import json
+import time
+import asyncio
+import itertools
+from aiohttp import web
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "Filmoteka", "username": "filmoteka_bench_bot"}
+
+
+class FakeTelegramServer:
+    # Подмена Bot API: отдаёт боту апдейты через getUpdates (long polling)
+    # и складывает ответы бота в очередь того чата, которому они адресованы.
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates = []
+        self._new_update = asyncio.Condition()
+        self._callbacks = {}
+        self._closed = False
+        self.outbox = {}
+        self.requests = 0
+
+    def chat_outbox(self, chat_id):
+        return self.outbox.setdefault(int(chat_id), asyncio.Queue())
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _chat(self, chat_id):
+        return {"id": chat_id, "type": "private"}
+
+    async def _push(self, update):
+        update["update_id"] = next(self._update_ids)
+        async with self._new_update:
+            self._updates.append(update)
+            self._new_update.notify_all()
+
+    async def send_text(self, user_id, text):
+        message = {
+            "message_id": next(self._message_ids), "date": int(time.time()),
+            "chat": self._chat(user_id), "from": self._user(user_id), "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        await self._push({"message": message})
+
+    async def press_button(self, user_id, message, data):
+        # message — ответ бота с клавиатурой, на которую «нажимает» пользователь
+        callback_id = str(next(self._update_ids))
+        self._callbacks[callback_id] = user_id
+        await self._push({"callback_query": {
+            "id": callback_id, "from": self._user(user_id), "chat_instance": str(user_id),
+            "message": {
+                "message_id": message["message_id"], "date": int(time.time()),
+                "chat": self._chat(user_id), "from": BOT_USER, "text": message.get("text") or "",
+            },
+            "data": data,
+        }})
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        async with self._new_update:
+            # Всё, что младше offset, бот уже подтвердил
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            if not self._updates and timeout and not self._closed:
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return list(self._updates)
+
+    async def close(self):
+        # Отпускаем висящий long poll, чтобы бот остановился сразу, а не по таймауту
+        async with self._new_update:
+            self._closed = True
+            self._new_update.notify_all()
+
+    def _bot_message(self, params, message_id=None):
+        chat_id = int(params["chat_id"])
+        message = {
+            "message_id": message_id or next(self._message_ids), "date": int(time.time()),
+            "chat": self._chat(chat_id), "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        if "photo" in params:
+            message["photo"] = [{"file_id": f"photo{message['message_id']}", "file_unique_id": f"u{message['message_id']}", "width": 1, "height": 1}]
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        if markup and "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        return chat_id, message
+
+    async def _handle(self, request: web.Request):
+        self.requests += 1
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "sendPhoto", "editMessageText", "editMessageReplyMarkup", "editMessageCaption", "editMessageMedia"):
+            message_id = int(params["message_id"]) if "message_id" in params else None
+            chat_id, result = self._bot_message(params, message_id)
+            self.chat_outbox(chat_id).put_nowait((method, result))
+        elif method == "answerCallbackQuery":
+            # Всплывающее предупреждение тоже ответ — нагрузочный клиент считает его ошибкой шага
+            user_id = self._callbacks.pop(params.get("callback_query_id"), None)
+            if user_id is not None and params.get("show_alert") == "true":
+                self.chat_outbox(user_id).put_nowait((method, {"text": params.get("text")}))
+            result = True
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        return app
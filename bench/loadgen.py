@@ -0,0 +1,140 @@
+import time
+import random
+import asyncio
+
+NEW_PROFILE = "➕ Новый профиль"
+REPLY_TIMEOUT = 30
+
+
+class StepFailed(Exception):
+    pass
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, step, seconds):
+        self.latencies.setdefault(step, []).append(seconds)
+
+    def fail(self, step):
+        self.errors[step] = self.errors.get(step, 0) + 1
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        total = sum(len(values) for values in self.latencies.values())
+        steps = {}
+        for step in dict.fromkeys([*self.latencies, *self.errors]):
+            values = self.latencies.get(step, [])
+            steps[step] = {
+                "count": len(values),
+                "errors": self.errors.get(step, 0),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+            }
+        return {"elapsed_s": round(elapsed, 3), "updates": total, "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0, "steps": steps}
+
+
+def buttons(message, prefix):
+    markup = message.get("reply_markup") or {}
+    return [button["callback_data"] for row in markup.get("inline_keyboard", []) for button in row
+            if button.get("callback_data", "").startswith(prefix)]
+
+
+class VirtualUser:
+    # Проходит реальные сценарии бота: /start → профиль → добавить фильм →
+    # список → подробности → оценка. Латентность шага — от отправки апдейта
+    # до первого ответа бота в этот чат.
+    def __init__(self, server, user_id, stats, rnd, titles=200):
+        self.server = server
+        self.user_id = user_id
+        self.stats = stats
+        self.random = rnd
+        self.titles = titles
+        self.outbox = server.chat_outbox(user_id)
+
+    async def _reply(self, step, send, expect=None):
+        while not self.outbox.empty():
+            self.outbox.get_nowait()
+        started = time.perf_counter()
+        await send
+        try:
+            method, message = await asyncio.wait_for(self.outbox.get(), REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.fail(step)
+            raise StepFailed(step)
+        self.stats.record(step, time.perf_counter() - started)
+        if method == "answerCallbackQuery" or (expect and expect not in (message.get("text") or message.get("caption") or "")):
+            self.stats.fail(step)
+            raise StepFailed(step)
+        return message
+
+    async def text(self, step, text, expect=None):
+        return await self._reply(step, self.server.send_text(self.user_id, text), expect)
+
+    async def press(self, step, message, data, expect=None):
+        return await self._reply(step, self.server.press_button(self.user_id, message, data), expect)
+
+    async def login(self):
+        # У каждого виртуального пользователя своя коллекция: при первом /start
+        # заводим профиль, дальше бот узнаёт пользователя сам
+        reply = await self.text("start", "/start")
+        if "выбран" not in (reply.get("text") or ""):
+            await self.text("profile", NEW_PROFILE, "выбран")
+
+    async def add_and_rate(self):
+        await self.text("add_prompt", "✅Добавить фильм", "Введите название")
+        found = await self.text("search", f"Фильм {self.random.randint(1, self.titles)}", "Выберите фильм")
+        choices = buttons(found, "choose_")
+        if not choices:
+            self.stats.fail("search")
+            raise StepFailed("search")
+        details = await self.press("choose", found, self.random.choice(choices), "🎥")
+        await self.press("add", details, buttons(details, "add_")[0], "добавлен")
+        films = await self.text("list", "📋Список фильмов", "Выберите фильм")
+        film_buttons = buttons(films, "details_")
+        if not film_buttons:
+            self.stats.fail("list")
+            raise StepFailed("list")
+        film = await self.press("details", films, self.random.choice(film_buttons), "🎥")
+        await self.press("rate_prompt", film, buttons(film, "rate_")[0], "оценку")
+        await self.text("rate", str(self.random.randint(1, 10)), "сохранена")
+
+    async def run(self, iterations):
+        try:
+            await self.login()
+            for _ in range(iterations):
+                try:
+                    await self.add_and_rate()
+                except StepFailed:
+                    # После сбоя возвращаемся в главное меню и продолжаем
+                    await self.login()
+        except StepFailed:
+            pass
+
+
+async def run_load(server, users, iterations, seed=0, titles=200, ramp_up=0.0):
+    stats = Stats()
+    rnd = random.Random(seed)
+    virtual_users = [VirtualUser(server, 10_000 + i, stats, random.Random(rnd.random()), titles) for i in range(users)]
+
+    async def start(index, user):
+        if ramp_up:
+            await asyncio.sleep(ramp_up * index / users)
+        await user.run(iterations)
+
+    await asyncio.gather(*(start(index, user) for index, user in enumerate(virtual_users)))
+    stats.finished = time.perf_counter()
+    return stats
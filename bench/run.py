@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+from aiohttp import web
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+sys.path.insert(0, str(ROOT))
+
+from bench.fake_telegram import FakeTelegramServer
+from bench.fake_kinopoisk import FakeKinopoiskServer
+from bench.loadgen import run_load
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на фейковых Telegram и Кинопоиске")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=5, help="сколько раз каждый пользователь проходит сценарий")
+    parser.add_argument("--titles", type=int, default=200, help="сколько разных поисковых запросов в ходу")
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--kp-latency", type=float, default=0.05, help="средняя задержка Кинопоиска, с")
+    parser.add_argument("--kp-error-rate", type=float, default=0.0, help="доля ответов 429/500/503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результат как новый baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="допустимое ухудшение p95/пропускной способности")
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    return parser.parse_args()
+
+
+async def start_site(app, port=0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, runner.addresses[0][1]
+
+
+def configure(telegram_port, kinopoisk_port):
+    # Всё окружение выставляется до импорта бота: модули читают его при импорте.
+    # Лимиты Кинопоиска по умолчанию подняты, чтобы мерить бота, а не ограничитель.
+    os.environ["BOT_TOKEN"] = "123456:BENCH"
+    os.environ["BOT_MODE"] = "polling"
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{telegram_port}"
+    os.environ["KINOPOISK_API_BASE"] = f"http://127.0.0.1:{kinopoisk_port}/v1.4/"
+    os.environ.setdefault("KINOPOISK_RATE", "1000")
+    os.environ.setdefault("KINOPOISK_BURST", "1000")
+    os.environ.setdefault("KINOPOISK_DAILY_QUOTA", "1000000")
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    if report["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput {report['throughput_rps']} < {baseline['throughput_rps']} rps")
+    for step, expected in baseline["steps"].items():
+        actual = report["steps"].get(step)
+        if actual is None:
+            regressions.append(f"{step}: шаг не выполнялся")
+            continue
+        if actual["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{step}: p95 {actual['p95_ms']} > {expected['p95_ms']} ms")
+        if actual["errors"] > expected["errors"]:
+            regressions.append(f"{step}: ошибок {actual['errors']} > {expected['errors']}")
+    return regressions
+
+
+def print_report(report):
+    print(f"{'step':<12}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, row in report["steps"].items():
+        print(f"{step:<12}{row['count']:>7}{row['errors']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    print(f"\n{report['updates']} updates in {report['elapsed_s']} s, {report['throughput_rps']} updates/s")
+
+
+async def main(args):
+    telegram = FakeTelegramServer()
+    kinopoisk = FakeKinopoiskServer(latency=args.kp_latency, error_rate=args.kp_error_rate, seed=args.seed)
+    telegram_runner, telegram_port = await start_site(telegram.app())
+    kinopoisk_runner, kinopoisk_port = await start_site(kinopoisk.app())
+    configure(telegram_port, kinopoisk_port)
+
+    # База бота — ./films.db, поэтому работаем в чистом временном каталоге
+    workdir = tempfile.TemporaryDirectory(prefix="filmoteka-bench-")
+    os.chdir(workdir.name)
+    import bot as botmod
+
+    await botmod.migrate(botmod.engine)
+    await botmod.kinopoisk_client.start()
+    polling = asyncio.create_task(botmod.dp.start_polling(botmod.bot, handle_signals=False))
+    try:
+        stats = await run_load(telegram, args.users, args.iterations, seed=args.seed, titles=args.titles, ramp_up=args.ramp_up)
+    finally:
+        await telegram.close()
+        await botmod.dp.stop_polling()
+        await polling
+        await botmod.kinopoisk_client.close()
+        await botmod.dp.storage.close()
+        await botmod.db_writer.close()
+        await botmod.engine.dispose()
+        await telegram_runner.cleanup()
+        await kinopoisk_runner.cleanup()
+        os.chdir(ROOT)
+        workdir.cleanup()
+
+    report = stats.report()
+    report["config"] = {
+        "users": args.users, "iterations": args.iterations, "titles": args.titles,
+        "kp_latency": args.kp_latency, "kp_error_rate": args.kp_error_rate,
+    }
+    report["kinopoisk_requests"] = kinopoisk.requests
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+        print(f"Kinopoisk requests: {kinopoisk.requests}")
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        if baseline.get("config") != report["config"]:
+            print("Baseline снят с другими параметрами, сравнение пропущено")
+            return 0
+        regressions = compare(report, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -1,27 +1,62 @@
+import re
+import sys
+import html
+import time
 import asyncio
+import logging
+import functools
+from contextlib import suppress
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.filters import Command, StateFilter
-from config import BOT_TOKEN
-from services import add_film_from_kinopoisk, get_random_film, get_all_films, search_films_kinopoisk, get_film_details_kinopoisk, mark_film_watched, delete_film, get_watched_films
-from database import engine, Base
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.exceptions import TelegramBadRequest, TelegramAPIError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import BOT_TOKEN, BOT_MODE, TELEGRAM_API_URL, LOG_LEVEL, METRICS_HOST, METRICS_PORT, ADMIN_IDS, SHUTDOWN_TIMEOUT, RESTART_EXIT_CODE
+from services import add_film_from_kinopoisk, get_random_film, get_film, get_films_page, iter_films, search_films_kinopoisk, get_film_details_kinopoisk, mark_film_watched, set_film_rating, set_film_comment, delete_film, schedule_prefetch, search_my_films, filter_films_page, get_facet_options, get_recommendations, get_poster_file_id, set_poster_file_id, resolve_import, add_films_bulk, get_film_entry, get_profile_name, get_unclaimed_profiles, create_profile, claim_profile, drain_background_tasks, schedule_background, get_shared_profiles, get_viewers, can_view, get_share_code, accept_share, revoke_share
+from database import engine
+from migrations import migrate
+from kinopoisk import kinopoisk_client
+from ratelimit import QuotaExceeded, api_budget
+from cache import response_cache, collection_cache, inline_cache
+from metrics import REGISTRY, setup_metrics, start_metrics_server
+from transfer import parse_import_file, ExportFile, IMPORT_MAX_BYTES
+from storage import SQLiteStorage
+from webhook import run_webhook
+from writer import db_writer
+from refresher import metadata_refresher
+from shutdown import UpdateTracker, load_offset, save_offset, confirm_offset
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
+logger = logging.getLogger(__name__)
+dp = Dispatcher(storage=SQLiteStorage())
+setup_metrics(dp)
+update_tracker = UpdateTracker()
+dp.update.outer_middleware(update_tracker)
+# Перезапуск из меню: main() дорабатывает начатое и выходит с RESTART_EXIT_CODE
+stop_requested = asyncio.Event()
+restart_requested = False
 
-# Главное меню с учётом профиля
-def get_main_kb(profile):
-    if profile == "Евгеша":
-        other = "Вандронович"
-    else:
-        other = "Евгеша"
+REGISTRY.gauge("kinopoisk_cache_hit_ratio", "Kinopoisk response cache hit ratio", lambda: response_cache.stats()["hit_ratio"])
+REGISTRY.gauge("collection_cache_hit_ratio", "Per-profile collection cache hit ratio", lambda: collection_cache.stats()["hit_ratio"])
+REGISTRY.gauge("kinopoisk_quota_remaining", "Kinopoisk requests left today", lambda: api_budget.quota.remaining)
+REGISTRY.gauge("db_writer_pending", "Writes waiting in the writer queue", db_writer.pending)
+REGISTRY.gauge("db_writer_batches", "Transactions committed by the writer", lambda: db_writer.batches)
+REGISTRY.gauge("db_writer_writes", "Operations committed by the writer", lambda: db_writer.writes)
+REGISTRY.gauge("metadata_refreshed_films", "Films refreshed from Kinopoisk in the background", lambda: metadata_refresher.refreshed)
+
+# Главное меню
+def get_main_kb():
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="✅Добавить фильм")],
             [KeyboardButton(text="⭐ Список просмотренных"), KeyboardButton(text="📋Список фильмов")],
-            [KeyboardButton(text=f"📂 Фильмы {other}")],
+            [KeyboardButton(text="📂 Другие коллекции"), KeyboardButton(text="🔍 Поиск по моим фильмам")],
+            [KeyboardButton(text="🎛 Фильтр"), KeyboardButton(text="🎯 Что посмотреть")],
+            [KeyboardButton(text="📥 Импорт"), KeyboardButton(text="📤 Экспорт")],
             [KeyboardButton(text="🔄 Перезапустить бота")],
         ],
         resize_keyboard=True
@@ -39,9 +74,143 @@ class RateCommentStates(StatesGroup):
     waiting_for_rating = State()
     waiting_for_comment = State()
 
-user_list = ["Евгеша", "Вандронович"]
+class SearchStates(StatesGroup):
+    waiting_for_query = State()
+
+class FilterStates(StatesGroup):
+    waiting_for_years = State()
+
+class ImportStates(StatesGroup):
+    waiting_for_file = State()
+
+NEW_PROFILE_TEXT = "➕ Новый профиль"
+# Сколько чужих коллекций показывать кнопками в меню рекомендаций
+RECOMMEND_PARTNERS_LIMIT = 8
+# Сколько профилей на странице в списках «Другие коллекции» и «Кто видит мою коллекцию»
+PROFILES_PAGE_SIZE = 10
+SHARE_PREFIX = "share_"
+NO_ACCESS_TEXT = "Эта коллекция вам недоступна."
+# Фильм удалили (например, из другого окна), а кнопки или ввод остались от старой карточки
+FILM_GONE_TEXT = "Этого фильма больше нет в вашей коллекции."
+
+QUOTA_EXCEEDED_TEXT = "Лимит запросов к Кинопоиску на сегодня исчерпан. Попробуйте позже."
+MESSAGE_LIMIT = 4096
+# Не чаще одного редактирования сообщения с прогрессом импорта за столько секунд
+IMPORT_PROGRESS_INTERVAL = 2
+CAPTION_LIMIT = 1024
+INLINE_RESULTS_LIMIT = 10
+INLINE_MIN_QUERY = 2
+# Пауза перед запросом к API: пока пользователь печатает, каждый новый символ её перезапускает
+INLINE_DEBOUNCE = 0.35
+# Сколько секунд Telegram может сам отвечать на тот же запрос, не спрашивая бота
+INLINE_CACHE_TIME = 300
+
+# Текущий inline-поиск каждого пользователя: новый запрос отменяет старый
+inline_searches = {}
+# Идущий в фоне импорт каждого пользователя: второй файл ждёт окончания первого
+imports = {}
+
+def caption_length(text):
+    # Telegram считает длину подписи без HTML-разметки и в UTF-16
+    plain = html.unescape(re.sub(r"<[^>]+>", "", text))
+    return len(plain.encode("utf-16-le")) // 2
+
+async def send_film_card(message: types.Message, text, poster_url=None, file_id=None, reply_markup=None):
+    # Постер уходит фото с подписью: сначала по сохранённому file_id (без скачивания),
+    # иначе по ссылке. Возвращает новый file_id, если Telegram загрузил постер заново.
+    if caption_length(text) <= CAPTION_LIMIT:
+        for photo in (file_id, poster_url):
+            if not photo:
+                continue
+            try:
+                sent = await message.answer_photo(photo, caption=text, parse_mode="HTML", reply_markup=reply_markup)
+            except TelegramBadRequest as e:
+                logger.info("poster send failed source=%s error=%s", "file_id" if photo == file_id else "url", e)
+                continue
+            return sent.photo[-1].file_id if photo != file_id else None
+    # Подпись слишком длинная или постер недоступен — карточка текстом со ссылкой
+    if poster_url:
+        text += f"\n<a href='{poster_url}'>Постер</a>"
+    await message.answer(text, parse_mode="HTML", reply_markup=reply_markup, disable_web_page_preview=True)
+    return None
+
+async def send_poster_card(message: types.Message, film, text, reply_markup=None):
+    new_file_id = await send_film_card(message, text, film.poster_url, film.poster_file_id, reply_markup)
+    if new_file_id:
+        await set_poster_file_id(new_file_id, kinopoisk_id=film.kinopoisk_id, film_id=film.film_id)
+
+async def edit_card_text(message: types.Message, text, reply_markup=None):
+    if message.photo:
+        await message.edit_caption(caption=text, reply_markup=reply_markup)
+    else:
+        await message.edit_text(text, reply_markup=reply_markup)
+
+def kinopoisk_card_text(film):
+    # film — словарь из поиска или подробностей Кинопоиска; в результатах поиска части полей нет
+    text = f"🎥 <b>{film['title']}</b>\nГод: {film.get('year') or '—'}\nЖанр: {film.get('genre') or '—'}"
+    if film.get('description'):
+        text += f"\nОписание: {film['description']}"
+    if film.get('director'):
+        text += f"\nРежиссер: {film['director']}"
+    if film.get('actors'):
+        text += f"\nАктеры: {film['actors']}"
+    if film.get('country'):
+        text += f"\nСтрана: {film['country']}"
+    if film.get('rating'):
+        text += f"\nРейтинг Кинопоиск: {film['rating']}"
+    if film.get('trailer_url'):
+        text += f"\n<a href='{film['trailer_url']}'>Трейлер</a>"
+    if film.get('watch_url'):
+        text += f"\n<a href='{film['watch_url']}'>Смотреть онлайн</a>"
+    return text
+
+def films_page_kb(films, details_prefix, page_prefix, has_prev, has_next):
+    rows = [
+        [InlineKeyboardButton(text=f"Подробнее: {film.title}", callback_data=f"{details_prefix}_{film.id}")]
+        for film in films
+    ]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"{page_prefix}_prev_{films[0].id}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=f"{page_prefix}_next_{films[-1].id}"))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def load_films_page(profile, callback_data, filters=None):
+    _, direction, film_id = callback_data.split("_", 2)
+    key = "after_id" if direction == "next" else "before_id"
+    if filters is not None:
+        return await filter_films_page(profile, filters, **{key: int(film_id)})
+    return await get_films_page(profile, **{key: int(film_id)})
+
+FACET_LABELS = {"genre": "Жанр", "director": "Режиссёр", "actor": "Актёр", "country": "Страна"}
+WATCHED_LABELS = {None: "все", True: "просмотренные", False: "непросмотренные"}
+
+def filter_menu_kb(filters):
+    rows = [
+        [InlineKeyboardButton(text=f"{label}: {(filters.get(facet) or [None, 'любой'])[1]}", callback_data=f"flt_pick_{facet}")]
+        for facet, label in FACET_LABELS.items()
+    ]
+    years = f"{filters.get('year_from') or '…'}–{filters.get('year_to') or '…'}"
+    rows.append([InlineKeyboardButton(text=f"Годы: {years}", callback_data="flt_years")])
+    rows.append([InlineKeyboardButton(text=f"Статус: {WATCHED_LABELS[filters.get('watched')]}", callback_data="flt_watched")])
+    rows.append([
+        InlineKeyboardButton(text="Показать", callback_data="flt_show"),
+        InlineKeyboardButton(text="Сбросить", callback_data="flt_reset"),
+    ])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def current_profile(data):
+    # Профиль — Telegram user_id владельца коллекции. Строка — имя профиля из старой
+    # версии бота: такой пользователь должен заново выбрать профиль через /start
+    profile = data.get("profile")
+    return profile if isinstance(profile, int) else None
 
 def ensure_profile(func):
+    # wraps — чтобы в метриках хендлер был виден под своим именем, а не как wrapper
+    @functools.wraps(func)
     async def wrapper(*args, **kwargs):
         state = kwargs.get("state")
         message = kwargs.get("message")
@@ -62,7 +231,7 @@ def ensure_profile(func):
         # Проверяем профиль
         if state is not None:
             data = await state.get_data()
-            if not data.get("profile"):
+            if current_profile(data) is None:
                 if message:
                     await message.answer("Сначала выберите пользователя через /start.")
                 elif callback:
@@ -74,10 +243,34 @@ def ensure_profile(func):
         return await func(*args, **kwargs)
     return wrapper
 
+async def accept_invite(message: types.Message, code: str, user_id: int):
+    owner = await accept_share(code, user_id)
+    if owner is None:
+        return await message.answer("Ссылка-приглашение недействительна: возможно, владелец её обновил.")
+    await message.answer(f"Вам открыта коллекция {await get_profile_name(owner)}: смотрите в «📂 Другие коллекции».")
+    # Владелец должен знать, кто видит его коллекцию; у старых именных профилей чата нет
+    if owner > 0:
+        with suppress(TelegramAPIError):
+            await bot.send_message(owner, f"{await get_profile_name(user_id)} теперь видит вашу коллекцию.")
+
 @dp.message(Command("start"))
-async def cmd_start(message: types.Message, state: FSMContext):
+async def cmd_start(message: types.Message, state: FSMContext, command: CommandObject):
+    user_id = message.from_user.id
+    code = command.args[len(SHARE_PREFIX):] if command.args and command.args.startswith(SHARE_PREFIX) else None
+    name = await get_profile_name(user_id)
+    if name:
+        await state.update_data(profile=user_id)
+        await state.set_state(UserStates.user_selected)
+        await message.answer(f"Профиль {name} выбран!", reply_markup=get_main_kb())
+        if code:
+            await accept_invite(message, code, user_id)
+        return
+    # Приглашение примем, когда профиль будет выбран
+    await state.update_data(invite=code)
+    # Новому пользователю предлагаем занять одну из старых именных коллекций или завести свою
+    names = await get_unclaimed_profiles(user_id)
     kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text=name)] for name in user_list],
+        keyboard=[[KeyboardButton(text=name)] for name in names] + [[KeyboardButton(text=NEW_PROFILE_TEXT)]],
         resize_keyboard=True
     )
     await message.answer("Выберите пользователя:", reply_markup=kb)
@@ -85,12 +278,22 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
 @dp.message(UserStates.choosing_user)
 async def choose_user(message: types.Message, state: FSMContext):
-    if message.text not in user_list:
+    user_id = message.from_user.id
+    if message.text == NEW_PROFILE_TEXT:
+        name = await create_profile(user_id, message.from_user.full_name)
+    elif message.text in await get_unclaimed_profiles(user_id):
+        name = await claim_profile(message.text, user_id)
+    else:
+        name = None
+    if not name:
         await message.answer("Пожалуйста, выберите пользователя из списка.")
         return
-    await state.update_data(profile=message.text)
+    data = await state.get_data()
+    await state.update_data(profile=user_id, invite=None)
     await state.set_state(UserStates.user_selected)
-    await message.answer(f"Профиль {message.text} выбран!", reply_markup=get_main_kb(message.text))
+    await message.answer(f"Профиль {name} выбран!", reply_markup=get_main_kb())
+    if data.get("invite"):
+        await accept_invite(message, data["invite"], user_id)
 
 @dp.message(StateFilter(UserStates.user_selected), F.text == "✅Добавить фильм")
 @ensure_profile
@@ -100,7 +303,11 @@ async def ask_film_title(message: types.Message, state: FSMContext, **kwargs):
 
 @dp.message(AddFilmStates.waiting_for_title)
 async def show_film_choices(message: types.Message, state: FSMContext):
-    films = await search_films_kinopoisk(message.text.strip())
+    try:
+        films = await search_films_kinopoisk(message.text.strip())
+    except QuotaExceeded:
+        await message.answer(QUOTA_EXCEEDED_TEXT)
+        return
     if not films:
         await message.answer("Фильмы не найдены. Попробуйте другое название.")
         return
@@ -113,31 +320,21 @@ async def show_film_choices(message: types.Message, state: FSMContext):
     await state.update_data(films=films)
     await message.answer("Выберите фильм из найденных:", reply_markup=kb)
     await state.set_state(AddFilmStates.waiting_for_choice)
+    # Подгружаем подробности всех найденных фильмов заранее, пока пользователь выбирает
+    schedule_prefetch(film["kinopoiskId"] for film in films)
 
 @dp.callback_query(AddFilmStates.waiting_for_choice, F.data.startswith("choose_"))
 async def show_film_details_for_add(callback: types.CallbackQuery, state: FSMContext):
     film_id = str(callback.data.split("_", 1)[1])
-    film = await get_film_details_kinopoisk(film_id)
+    try:
+        film = await get_film_details_kinopoisk(film_id)
+    except QuotaExceeded:
+        await callback.answer(QUOTA_EXCEEDED_TEXT, show_alert=True)
+        return
     if not film:
         await callback.answer("Не удалось получить подробности фильма. Попробуйте позже.", show_alert=True)
         return
-    text = f"🎥 <b>{film['title']}</b>\nГод: {film['year'] or '—'}\nЖанр: {film['genre'] or '—'}"
-    if film['description']:
-        text += f"\nОписание: {film['description']}"
-    if film['director']:
-        text += f"\nРежиссер: {film['director']}"
-    if film['actors']:
-        text += f"\nАктеры: {film['actors']}"
-    if film['country']:
-        text += f"\nСтрана: {film['country']}"
-    if film['rating']:
-        text += f"\nРейтинг Кинопоиск: {film['rating']}"
-    if film['trailer_url']:
-        text += f"\n<a href='{film['trailer_url']}'>Трейлер</a>"
-    if film['poster_url']:
-        text += f"\n<a href='{film['poster_url']}'>Постер</a>"
-    if film.get('watch_url'):
-        text += f"\n<a href='{film['watch_url']}'>Смотреть онлайн</a>"
+    text = kinopoisk_card_text(film)
     kb = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="Добавить этот фильм", callback_data=f"add_{film_id}")],
@@ -145,20 +342,30 @@ async def show_film_details_for_add(callback: types.CallbackQuery, state: FSMCon
             [InlineKeyboardButton(text="Отмена", callback_data="cancel_add")]
         ]
     )
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
+    # Карточка с фото не может заменить текстовый список, поэтому список удаляем
+    film = {**film, "poster_file_id": film.get("poster_file_id") or await get_poster_file_id(film["kinopoiskId"])}
+    # Выбранный фильм сохраняем до отправки карточки: кнопку «Добавить» могут нажать сразу
     await state.update_data(selected_film=film)
+    with suppress(TelegramBadRequest):
+        await callback.message.delete()
+    new_file_id = await send_film_card(callback.message, text, film["poster_url"], film["poster_file_id"], kb)
+    if new_file_id:
+        await state.update_data(selected_film={**film, "poster_file_id": new_file_id})
+        await set_poster_file_id(new_file_id, kinopoisk_id=film["kinopoiskId"])
+    await callback.answer()
 
 @dp.callback_query(AddFilmStates.waiting_for_choice, F.data.startswith("add_"))
-async def confirm_add_film(callback: types.CallbackQuery, state: FSMContext):
+@ensure_profile
+async def confirm_add_film(callback: types.CallbackQuery, state: FSMContext, **kwargs):
     film_id = int(callback.data.split("_", 1)[1])
     data = await state.get_data()
     film = data.get("selected_film")
-    profile = data.get("profile")
+    profile = current_profile(data)
     if not film or film["kinopoiskId"] != film_id:
         await callback.answer("Ошибка добавления.", show_alert=True)
         return
     await add_film_from_kinopoisk(film, profile)
-    await callback.message.edit_text("Фильм успешно добавлен в коллекцию!", reply_markup=None)
+    await edit_card_text(callback.message, "Фильм успешно добавлен в коллекцию!")
     await state.clear()
     await state.set_state(UserStates.user_selected)
     await state.update_data(profile=profile)
@@ -173,11 +380,14 @@ async def back_to_list(callback: types.CallbackQuery, state: FSMContext):
             for film in films
         ] + [[InlineKeyboardButton(text="Отмена", callback_data="cancel_add")]]
     )
-    await callback.message.edit_text("Выберите фильм из найденных:", reply_markup=kb)
+    with suppress(TelegramBadRequest):
+        await callback.message.delete()
+    await callback.message.answer("Выберите фильм из найденных:", reply_markup=kb)
+    await callback.answer()
 
 @dp.callback_query(AddFilmStates.waiting_for_choice, F.data == "cancel_add")
 async def cancel_add_film(callback: types.CallbackQuery, state: FSMContext):
-    await callback.message.edit_text("Добавление фильма отменено.", reply_markup=None)
+    await edit_card_text(callback.message, "Добавление фильма отменено.")
     await state.set_state(UserStates.user_selected)
     await state.update_data(selected_film=None)
 
@@ -185,45 +395,54 @@ async def cancel_add_film(callback: types.CallbackQuery, state: FSMContext):
 @ensure_profile
 async def watched_list(message: types.Message, state: FSMContext, **kwargs):
     data = await state.get_data()
-    profile = data.get("profile")
-    films = await get_watched_films(profile)
-    if not films:
-        return await message.answer("Список просмотренных фильмов пуст.")
-    blocks = []
-    for film in films:
+    profile = current_profile(data)
+    # Отправляем список несколькими сообщениями, каждое не длиннее лимита Telegram
+    text = "⭐ Просмотренные фильмы:\n"
+    count = 0
+    async for film in iter_films(profile, watched=True):
         block = f"• {film.title} ({film.year or '—'})"
         if film.rating_user:
             block += f"\nОценка: {film.rating_user}/10"
         if film.comment_user:
             block += f"\nОтзыв: {film.comment_user}"
-        blocks.append(block)
-    text = "\n\n".join(blocks)
-    await message.answer("⭐ Просмотренные фильмы:\n" + text)
+        separator = "\n\n" if count else ""
+        if len(text) + len(separator) + len(block) > MESSAGE_LIMIT:
+            await message.answer(text)
+            text, separator = "", ""
+        text += separator + block[:MESSAGE_LIMIT]
+        count += 1
+    if not count:
+        return await message.answer("Список просмотренных фильмов пуст.")
+    await message.answer(text)
 
 @dp.message(StateFilter(UserStates.user_selected), F.text == "📋Список фильмов")
 @ensure_profile
 async def cmd_list(message: types.Message, state: FSMContext, **kwargs):
     data = await state.get_data()
-    profile = data.get("profile")
-    films = await get_all_films(profile)
+    profile = current_profile(data)
+    films, has_prev, has_next = await get_films_page(profile)
     if not films:
         return await message.answer("Список пуст.")
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=f"Подробнее: {film.title}", callback_data=f"details_{film.id}")]
-            for film in films
-        ]
-    )
+    kb = films_page_kb(films, "details", "page", has_prev, has_next)
     await message.answer("Выберите фильм для подробностей:", reply_markup=kb)
 
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("page_"))
+@ensure_profile
+async def cmd_list_page(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    films, has_prev, has_next = await load_films_page(current_profile(data), callback.data)
+    if not films:
+        return await callback.answer("Больше фильмов нет.")
+    await callback.message.edit_reply_markup(reply_markup=films_page_kb(films, "details", "page", has_prev, has_next))
+    await callback.answer()
+
 @dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("details_"))
 @ensure_profile
 async def show_film_details(callback: types.CallbackQuery, state: FSMContext, **kwargs):
     data = await state.get_data()
-    profile = data.get("profile")
-    films = await get_all_films(profile)
+    profile = current_profile(data)
     film_id = int(callback.data.split("_", 1)[1])
-    film = next((f for f in films if f.id == film_id), None)
+    film = await get_film(film_id, profile)
     if film:
         text = f"🎥 <b>{film.title}</b>\nГод: {film.year or '—'}\nЖанр: {film.genre or '—'}"
         if film.description:
@@ -238,8 +457,6 @@ async def show_film_details(callback: types.CallbackQuery, state: FSMContext, **
             text += f"\nРейтинг Кинопоиск: {film.rating}"
         if film.trailer_url:
             text += f"\n<a href='{film.trailer_url}'>Трейлер</a>"
-        if film.poster_url:
-            text += f"\n<a href='{film.poster_url}'>Постер</a>"
         if film.watch_url:
             text += f"\n<a href='{film.watch_url}'>Смотреть онлайн</a>"
         watched_text = "✅ Просмотрено" if film.watched else "❌ Не просмотрено"
@@ -256,21 +473,25 @@ async def show_film_details(callback: types.CallbackQuery, state: FSMContext, **
                  InlineKeyboardButton(text="Отметить как просмотренный", callback_data=f"watched_{film.id}")]
             ]
         )
-        await callback.message.answer(text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
+        await send_poster_card(callback.message, film, text, kb)
     await callback.answer()
 
 @dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("delete_"))
-async def delete_film_callback(callback: types.CallbackQuery):
+@ensure_profile
+async def delete_film_callback(callback: types.CallbackQuery, state: FSMContext, **kwargs):
     film_id = int(callback.data.split("_", 1)[1])
-    await delete_film(film_id)
-    await callback.message.edit_text("Фильм удалён из коллекции.")
+    data = await state.get_data()
+    deleted = await delete_film(film_id, current_profile(data))
+    await edit_card_text(callback.message, "Фильм удалён из коллекции." if deleted else FILM_GONE_TEXT)
     await callback.answer()
 
 @dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("watched_"))
-async def watched_film_callback(callback: types.CallbackQuery):
+@ensure_profile
+async def watched_film_callback(callback: types.CallbackQuery, state: FSMContext, **kwargs):
     film_id = int(callback.data.split("_", 1)[1])
-    await mark_film_watched(film_id)
-    await callback.message.edit_text("Фильм отмечен как просмотренный!")
+    data = await state.get_data()
+    marked = await mark_film_watched(film_id, current_profile(data))
+    await edit_card_text(callback.message, "Фильм отмечен как просмотренный!" if marked else FILM_GONE_TEXT)
     await callback.answer()
 
 @dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("rate_"))
@@ -283,7 +504,8 @@ async def rate_film(callback: types.CallbackQuery, state: FSMContext, **kwargs):
     await callback.answer()
 
 @dp.message(RateCommentStates.waiting_for_rating)
-async def save_rating(message: types.Message, state: FSMContext):
+@ensure_profile
+async def save_rating(message: types.Message, state: FSMContext, **kwargs):
     try:
         rating = int(message.text.strip())
         if not (1 <= rating <= 10):
@@ -293,15 +515,12 @@ async def save_rating(message: types.Message, state: FSMContext):
         return
     data = await state.get_data()
     film_id = data.get("rate_film_id")
-    profile = data.get("profile")
+    profile = current_profile(data)
     # Обновляем оценку в базе
-    from services import SessionLocal, Film
-    async with SessionLocal() as session:
-        film = await session.get(Film, film_id)
-        if film and film.profile == profile:
-            film.rating_user = rating
-            await session.commit()
-    await message.answer(f"Ваша оценка {rating}/10 сохранена!")
+    if await set_film_rating(film_id, profile, rating):
+        await message.answer(f"Ваша оценка {rating}/10 сохранена!")
+    else:
+        await message.answer(FILM_GONE_TEXT)
     await state.set_state(UserStates.user_selected)
 
 @dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("comment_"))
@@ -314,56 +533,412 @@ async def comment_film(callback: types.CallbackQuery, state: FSMContext, **kwarg
     await callback.answer()
 
 @dp.message(RateCommentStates.waiting_for_comment)
-async def save_comment(message: types.Message, state: FSMContext):
+@ensure_profile
+async def save_comment(message: types.Message, state: FSMContext, **kwargs):
     comment = message.text.strip()
     if len(comment) > 500:
         await message.answer("Комментарий слишком длинный. Пожалуйста, до 500 символов.")
         return
     data = await state.get_data()
     film_id = data.get("comment_film_id")
-    profile = data.get("profile")
-    from services import SessionLocal, Film
-    async with SessionLocal() as session:
-        film = await session.get(Film, film_id)
-        if film and film.profile == profile:
-            film.comment_user = comment
-            await session.commit()
-    await message.answer("Комментарий сохранён!")
+    profile = current_profile(data)
+    if await set_film_comment(film_id, profile, comment):
+        await message.answer("Комментарий сохранён!")
+    else:
+        await message.answer(FILM_GONE_TEXT)
+    await state.set_state(UserStates.user_selected)
+
+@dp.message(StateFilter(UserStates.user_selected), F.text == "🔍 Поиск по моим фильмам")
+@ensure_profile
+async def ask_search_query(message: types.Message, state: FSMContext, **kwargs):
+    await message.answer("Введите название, режиссёра, актёра или жанр:")
+    await state.set_state(SearchStates.waiting_for_query)
+
+@dp.message(SearchStates.waiting_for_query)
+async def search_collection(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    films = await search_my_films(current_profile(data), message.text or "")
+    await state.set_state(UserStates.user_selected)
+    if not films:
+        return await message.answer("В вашей коллекции ничего не найдено.")
+    kb = films_page_kb(films, "details", "page", False, False)
+    await message.answer("Найденные фильмы:", reply_markup=kb)
+
+@dp.message(StateFilter(UserStates.user_selected), F.text == "🎛 Фильтр")
+@ensure_profile
+async def filter_menu(message: types.Message, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    await message.answer("Фильтр фильмов:", reply_markup=filter_menu_kb(data.get("filters") or {}))
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("flt_pick_"))
+@ensure_profile
+async def filter_pick_facet(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    facet = callback.data.split("_", 2)[2]
+    data = await state.get_data()
+    options = await get_facet_options(current_profile(data), facet)
+    # Запоминаем названия, чтобы не искать их в базе при выборе
+    await state.update_data(facet_options={str(option_id): name for option_id, name, _ in options})
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=f"{name} ({count})", callback_data=f"flt_set_{facet}_{option_id}")]
+            for option_id, name, count in options
+        ] + [[InlineKeyboardButton(text="Любой", callback_data=f"flt_set_{facet}_0"),
+              InlineKeyboardButton(text="Назад", callback_data="flt_menu")]]
+    )
+    await callback.message.edit_text(f"{FACET_LABELS[facet]}:", reply_markup=kb)
+    await callback.answer()
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("flt_set_"))
+@ensure_profile
+async def filter_set_facet(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    _, _, facet, option_id = callback.data.split("_", 3)
+    data = await state.get_data()
+    filters = dict(data.get("filters") or {})
+    name = (data.get("facet_options") or {}).get(option_id)
+    filters[facet] = [int(option_id), name] if option_id != "0" and name else None
+    await state.update_data(filters=filters, facet_options=None)
+    await callback.message.edit_text("Фильтр фильмов:", reply_markup=filter_menu_kb(filters))
+    await callback.answer()
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.in_({"flt_menu", "flt_watched", "flt_reset"}))
+@ensure_profile
+async def filter_update(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    filters = dict(data.get("filters") or {})
+    if callback.data == "flt_watched":
+        filters["watched"] = {None: True, True: False, False: None}[filters.get("watched")]
+    elif callback.data == "flt_reset":
+        filters = {}
+    await state.update_data(filters=filters)
+    await callback.message.edit_text("Фильтр фильмов:", reply_markup=filter_menu_kb(filters))
+    await callback.answer()
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data == "flt_years")
+@ensure_profile
+async def filter_ask_years(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    await callback.message.answer("Введите годы в формате 1990-2000 (или один год, или «-» чтобы сбросить):")
+    await state.set_state(FilterStates.waiting_for_years)
+    await callback.answer()
+
+@dp.message(FilterStates.waiting_for_years)
+async def filter_save_years(message: types.Message, state: FSMContext):
+    text = (message.text or "").strip()
+    parts = [part.strip() for part in text.split("-")]
+    if text == "-":
+        year_from = year_to = None
+    elif len(parts) == 1 and parts[0].isdigit():
+        year_from = year_to = int(parts[0])
+    elif len(parts) == 2 and all(part.isdigit() or not part for part in parts) and any(parts):
+        year_from, year_to = (int(part) if part else None for part in parts)
+    else:
+        await message.answer("Не понял. Пример: 1990-2000")
+        return
+    data = await state.get_data()
+    filters = dict(data.get("filters") or {}, year_from=year_from, year_to=year_to)
+    await state.update_data(filters=filters)
     await state.set_state(UserStates.user_selected)
+    await message.answer("Фильтр фильмов:", reply_markup=filter_menu_kb(filters))
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data == "flt_show")
+@ensure_profile
+async def filter_show(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    films, has_prev, has_next = await filter_films_page(current_profile(data), data.get("filters") or {})
+    if not films:
+        return await callback.answer("Под фильтр ничего не подходит.", show_alert=True)
+    await callback.message.answer("Фильмы по фильтру:", reply_markup=films_page_kb(films, "details", "fltpage", has_prev, has_next))
+    await callback.answer()
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("fltpage_"))
+@ensure_profile
+async def filter_page(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    films, has_prev, has_next = await load_films_page(current_profile(data), callback.data, data.get("filters") or {})
+    if not films:
+        return await callback.answer("Больше фильмов нет.")
+    await callback.message.edit_reply_markup(reply_markup=films_page_kb(films, "details", "fltpage", has_prev, has_next))
+    await callback.answer()
+
+@dp.message(StateFilter(UserStates.user_selected), F.text == "🎯 Что посмотреть")
+@ensure_profile
+async def recommend_menu(message: types.Message, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    # Вместе — только с теми, кто открыл пользователю свою коллекцию
+    partners = list((await get_shared_profiles(current_profile(data))).items())
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Мне", callback_data="rec_me")]] + [
+        [InlineKeyboardButton(text=f"Мне и {name}", callback_data=f"rec_with_{user_id}")]
+        for user_id, name in partners[:RECOMMEND_PARTNERS_LIMIT]
+    ])
+    await message.answer("Кому подобрать фильм?", reply_markup=kb)
+
+@dp.callback_query(StateFilter(UserStates.user_selected), (F.data == "rec_me") | F.data.startswith("rec_with_"))
+@ensure_profile
+async def recommend_films(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    profile = current_profile(data)
+    together = callback.data.startswith("rec_with_")
+    shared = await get_shared_profiles(profile)
+    profiles = [profile, int(callback.data.rsplit("_", 1)[1])] if together else [profile]
+    if together and profiles[1] not in shared:
+        return await callback.answer(NO_ACCESS_TEXT, show_alert=True)
+    recommended = await get_recommendations(profiles, [profile, *shared])
+    if not recommended:
+        await callback.answer()
+        return await callback.message.answer("Пока нечего посоветовать: добавьте и оцените несколько фильмов.")
+    names = shared
+    # Фильмы из чужой коллекции открываются через otherdetails_
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text=film.title if owner == profile else f"{film.title} (у {names.get(owner, '—')})",
+            callback_data=f"{'details' if owner == profile else 'otherdetails'}_{film.id}",
+        )]
+        for film, owner in recommended
+    ])
+    title = "Понравится вам обоим:" if together else "Рекомендуем посмотреть:"
+    await callback.message.answer(title, reply_markup=kb)
+    await callback.answer()
+
+@dp.message(StateFilter(UserStates.user_selected), F.text == "📥 Импорт")
+@ensure_profile
+async def ask_import_file(message: types.Message, state: FSMContext, **kwargs):
+    await message.answer(
+        "Пришлите файл со списком фильмов:\n"
+        "• .txt — по названию в строке, можно с годом: «Гонка (2013)»\n"
+        "• .csv — экспорт Letterboxd или IMDb либо таблица с колонками title/название и year/год"
+    )
+    await state.set_state(ImportStates.waiting_for_file)
+
+async def run_import(status: types.Message, items, profile: int):
+    last_edit = time.monotonic()
+
+    async def progress(done, total):
+        nonlocal last_edit
+        # Прогресс пишем в одно сообщение и не чаще раза в пару секунд
+        if done < total and time.monotonic() - last_edit < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        with suppress(TelegramBadRequest):
+            await status.edit_text(f"Импорт: ищу фильмы {done}/{total}…")
+
+    try:
+        films, missing, skipped = await resolve_import(items, progress)
+        film_ids = await add_films_bulk(films, profile)
+    except asyncio.CancelledError:
+        with suppress(TelegramAPIError):
+            await status.edit_text("Импорт прерван перезапуском бота. Пришлите файл ещё раз.")
+        raise
+    except Exception:
+        logger.exception("import failed user=%s items=%d", profile, len(items))
+        with suppress(TelegramAPIError):
+            await status.edit_text("Импорт не удался. Попробуйте позже.")
+        return
+    text = (
+        f"Импорт завершён: добавлено {len(film_ids)}, уже были в коллекции или повторялись {len(films) - len(film_ids)}, "
+        f"не найдено {len(missing)}."
+    )
+    if skipped:
+        text += f"\nЛимит запросов к Кинопоиску на сегодня исчерпан, не обработано {skipped}. Пришлите файл ещё раз позже."
+    if missing:
+        text += "\nНе найдены: " + ", ".join(missing[:30]) + (" и другие" if len(missing) > 30 else "")
+    with suppress(TelegramAPIError):
+        await status.edit_text(text[:MESSAGE_LIMIT])
+
+@dp.message(ImportStates.waiting_for_file, F.document)
+@ensure_profile
+async def import_films(message: types.Message, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    profile = current_profile(data)
+    await state.set_state(UserStates.user_selected)
+    if profile in imports:
+        return await message.answer("Предыдущий импорт ещё идёт, дождитесь его окончания.")
+    document = message.document
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        return await message.answer("Файл слишком большой.")
+    # Место занимаем до первого await, иначе два файла подряд оба пройдут проверку выше
+    imports[profile] = None
+    task = None
+    try:
+        content = await bot.download(document)
+        items = parse_import_file(document.file_name, content.read())
+        if not items:
+            return await message.answer("Не нашёл в файле ни одного названия.")
+        status = await message.answer(f"Импорт: ищу фильмы 0/{len(items)}…")
+        # Поиск сотен названий идёт минутами — в фоне, чтобы не держать обработку
+        # апдейтов (в webhook-режиме это целый воркер вместе с его чатами)
+        task = imports[profile] = schedule_background(run_import(status, items, profile))
+        task.add_done_callback(lambda _: imports.pop(profile, None))
+    finally:
+        if task is None:
+            imports.pop(profile, None)
+
+@dp.message(ImportStates.waiting_for_file)
+async def import_not_file(message: types.Message, state: FSMContext):
+    await state.set_state(UserStates.user_selected)
+    await message.answer("Импорт отменён: нужен файл .txt или .csv.")
+
+@dp.message(StateFilter(UserStates.user_selected), F.text == "📤 Экспорт")
+@ensure_profile
+async def export_menu(message: types.Message, state: FSMContext, **kwargs):
+    kb = InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="CSV", callback_data="export_csv"),
+        InlineKeyboardButton(text="JSON", callback_data="export_json"),
+    ]])
+    await message.answer("В каком формате выгрузить коллекцию?", reply_markup=kb)
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.in_({"export_csv", "export_json"}))
+@ensure_profile
+async def export_collection(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    profile = current_profile(data)
+    fmt = callback.data.split("_", 1)[1]
+    await callback.answer()
+    # Файл собирается порциями прямо во время отправки, коллекция целиком в память не читается
+    await callback.message.answer_document(ExportFile(iter_films(profile), fmt, f"filmoteka_{profile}.{fmt}"))
 
 @dp.message(StateFilter(UserStates.user_selected), F.text == "🔄 Перезапустить бота")
 @ensure_profile
 async def restart_bot(message: types.Message, state: FSMContext, **kwargs):
-    await message.answer("Бот будет перезапущен. Пожалуйста, перезапустите процесс вручную (или используйте supervisor/systemd, если настроено).")
-    # Для ручного завершения процесса (если нужно):
-    # import os; os._exit(0)
+    global restart_requested
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("Перезапускать бота может только администратор.")
+        return
+    await message.answer("Бот перезапускается: доделаю начатые запросы и вернусь через несколько секунд.")
+    logger.info("restart requested user=%s", message.from_user.id)
+    # Сам хендлер не ждёт остановки — он тоже в числе апдейтов, которые main() дорабатывает
+    restart_requested = True
+    stop_requested.set()
 
-@dp.message(StateFilter(UserStates.user_selected), F.text.regexp(r"^📂 Фильмы "))
+def profiles_page_kb(profiles, offset, item_prefix, page_prefix, label=lambda name: name, extra_rows=()):
+    page = list(profiles.items())[offset:offset + PROFILES_PAGE_SIZE]
+    rows = [[InlineKeyboardButton(text=label(name), callback_data=f"{item_prefix}_{user_id}")] for user_id, name in page]
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"{page_prefix}_{max(offset - PROFILES_PAGE_SIZE, 0)}"))
+    if offset + PROFILES_PAGE_SIZE < len(profiles):
+        nav.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=f"{page_prefix}_{offset + PROFILES_PAGE_SIZE}"))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows + list(extra_rows))
+
+SHARE_ROWS = (
+    [InlineKeyboardButton(text="🔗 Пригласить", callback_data="share_link"),
+     InlineKeyboardButton(text="👥 Кто видит мою", callback_data="share_viewers")],
+)
+
+def others_kb(others, offset=0):
+    return profiles_page_kb(others, offset, "others", "otherslist", extra_rows=SHARE_ROWS)
+
+def viewers_kb(viewers, offset=0):
+    return profiles_page_kb(viewers, offset, "unshare", "viewerslist", label=lambda name: f"🚫 {name}")
+
+async def show_other_collection(message: types.Message, state: FSMContext, other: int, name: str):
+    films, has_prev, has_next = await get_films_page(other)
+    if not films:
+        return await message.answer(f"У пользователя {name} нет фильмов.")
+    # Листание чужой коллекции продолжается по otherpage_, владелец запоминается в состоянии
+    await state.update_data(other=other)
+    kb = films_page_kb(films, "otherdetails", "otherpage", has_prev, has_next)
+    await message.answer(f"Фильмы пользователя {name}:", reply_markup=kb)
+
+@dp.message(StateFilter(UserStates.user_selected), F.text == "📂 Другие коллекции")
 @ensure_profile
 async def other_user_films(message: types.Message, state: FSMContext, **kwargs):
+    # Видны только коллекции, владельцы которых прислали пользователю приглашение
     data = await state.get_data()
-    profile = data.get("profile")
-    other = "Вандронович" if profile == "Евгеша" else "Евгеша"
-    films = await get_all_films(other)
-    if not films:
-        return await message.answer(f"У пользователя {other} нет фильмов.")
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=f"Подробнее: {film.title}", callback_data=f"otherdetails_{film.id}")]
-            for film in films
-        ]
+    others = await get_shared_profiles(current_profile(data))
+    if not others:
+        return await message.answer(
+            "Вам пока никто не открыл свою коллекцию. Попросите друга прислать ссылку-приглашение "
+            "или отправьте свою — её даёт кнопка «🔗 Пригласить».",
+            reply_markup=others_kb(others),
+        )
+    await message.answer("Чью коллекцию открыть?", reply_markup=others_kb(others))
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("otherslist_"))
+@ensure_profile
+async def other_collections_page(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    others = await get_shared_profiles(current_profile(data))
+    await callback.message.edit_reply_markup(reply_markup=others_kb(others, int(callback.data.split("_", 1)[1])))
+    await callback.answer()
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("others_"))
+@ensure_profile
+async def other_collection_chosen(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    other = int(callback.data.split("_", 1)[1])
+    if not await can_view(current_profile(data), other):
+        return await callback.answer(NO_ACCESS_TEXT, show_alert=True)
+    await show_other_collection(callback.message, state, other, await get_profile_name(other) or "—")
+    await callback.answer()
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.in_({"share_link", "share_renew"}))
+@ensure_profile
+async def share_link(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    code = await get_share_code(current_profile(data), renew=callback.data == "share_renew")
+    me = await bot.me()
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="♻️ Новая ссылка", callback_data="share_renew")]])
+    await callback.message.answer(
+        "Отправьте эту ссылку тем, кому хотите открыть свою коллекцию (только просмотр):\n"
+        f"https://t.me/{me.username}?start={SHARE_PREFIX}{code}\n\n"
+        "«Новая ссылка» отключает старую; закрыть доступ уже приглашённым можно в «👥 Кто видит мою».",
+        reply_markup=kb,
     )
-    await message.answer(f"Фильмы пользователя {other}:", reply_markup=kb)
+    await callback.answer()
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data == "share_viewers")
+@ensure_profile
+async def share_viewers(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    viewers = await get_viewers(current_profile(data))
+    await callback.answer()
+    if not viewers:
+        return await callback.message.answer("Вашу коллекцию пока никто не видит.")
+    await callback.message.answer("Вашу коллекцию видят (нажмите, чтобы закрыть доступ):", reply_markup=viewers_kb(viewers))
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("viewerslist_"))
+@ensure_profile
+async def share_viewers_page(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    viewers = await get_viewers(current_profile(data))
+    await callback.message.edit_reply_markup(reply_markup=viewers_kb(viewers, int(callback.data.split("_", 1)[1])))
+    await callback.answer()
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("unshare_"))
+@ensure_profile
+async def share_revoke(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    profile = current_profile(data)
+    viewer = int(callback.data.split("_", 1)[1])
+    await revoke_share(profile, viewer)
+    viewers = await get_viewers(profile)
+    with suppress(TelegramBadRequest):
+        await callback.message.edit_reply_markup(reply_markup=viewers_kb(viewers) if viewers else None)
+    await callback.answer(f"Доступ для {await get_profile_name(viewer) or '—'} закрыт.")
+
+@dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("otherpage_"))
+@ensure_profile
+async def other_user_films_page(callback: types.CallbackQuery, state: FSMContext, **kwargs):
+    data = await state.get_data()
+    if data.get("other") is None:
+        return await callback.answer("Откройте коллекцию заново.")
+    if not await can_view(current_profile(data), data["other"]):
+        return await callback.answer(NO_ACCESS_TEXT, show_alert=True)
+    films, has_prev, has_next = await load_films_page(data["other"], callback.data)
+    if not films:
+        return await callback.answer("Больше фильмов нет.")
+    await callback.message.edit_reply_markup(reply_markup=films_page_kb(films, "otherdetails", "otherpage", has_prev, has_next))
+    await callback.answer()
 
 @dp.callback_query(StateFilter(UserStates.user_selected), F.data.startswith("otherdetails_"))
 @ensure_profile
 async def show_other_film_details(callback: types.CallbackQuery, state: FSMContext, **kwargs):
-    data = await state.get_data()
-    profile = data.get("profile")
-    other = "Вандронович" if profile == "Евгеша" else "Евгеша"
-    films = await get_all_films(other)
     film_id = int(callback.data.split("_", 1)[1])
-    film = next((f for f in films if f.id == film_id), None)
+    data = await state.get_data()
+    film = await get_film_entry(film_id)
+    if film and not await can_view(current_profile(data), film.user_id):
+        return await callback.answer(NO_ACCESS_TEXT, show_alert=True)
     if film:
         text = f"🎥 <b>{film.title}</b>\nГод: {film.year or '—'}\nЖанр: {film.genre or '—'}"
         if film.description:
@@ -378,8 +953,6 @@ async def show_other_film_details(callback: types.CallbackQuery, state: FSMConte
             text += f"\nРейтинг Кинопоиск: {film.rating}"
         if film.trailer_url:
             text += f"\n<a href='{film.trailer_url}'>Трейлер</a>"
-        if film.poster_url:
-            text += f"\n<a href='{film.poster_url}'>Постер</a>"
         if film.watch_url:
             text += f"\n<a href='{film.watch_url}'>Смотреть онлайн</a>"
         watched_text = "✅ Просмотрено" if film.watched else "❌ Не просмотрено"
@@ -388,22 +961,163 @@ async def show_other_film_details(callback: types.CallbackQuery, state: FSMConte
             text += f"\nОценка: {film.rating_user}/10"
         if film.comment_user:
             text += f"\nКомментарий: {film.comment_user}"
-        await callback.message.answer(text, parse_mode="HTML", disable_web_page_preview=True)
+        await send_poster_card(callback.message, film, text)
     await callback.answer()
 
+async def run_inline_search(query):
+    films = inline_cache.get(query)
+    if films is not None:
+        return films
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    films = await search_films_kinopoisk(query, limit=INLINE_RESULTS_LIMIT)
+    inline_cache.set(query, films)
+    return films
+
+def inline_film_result(film):
+    kb = InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="➕ В мою коллекцию", callback_data=f"inline_add_{film['kinopoiskId']}")]]
+    )
+    genres = ", ".join(film.get("genres") or []) or film.get("genre")
+    return types.InlineQueryResultArticle(
+        id=str(film["kinopoiskId"]),
+        title=f"{film['title']} ({film['year'] or '—'})",
+        description=" · ".join(part for part in (genres, film.get("rating") and f"КП {film['rating']}") if part),
+        thumbnail_url=film.get("poster_url"),
+        input_message_content=types.InputTextMessageContent(message_text=kinopoisk_card_text({**film, "genre": genres}), parse_mode="HTML"),
+        reply_markup=kb,
+    )
+
+@dp.inline_query()
+async def inline_search(inline_query: types.InlineQuery, state: FSMContext):
+    # state — контекст личного чата пользователя с ботом, там выбран профиль
+    data = await state.get_data()
+    button = None
+    if current_profile(data) is None:
+        button = types.InlineQueryResultsButton(text="Выберите профиль, чтобы добавлять фильмы", start_parameter="inline")
+    query = inline_query.query.strip()
+    films = []
+    if len(query) >= INLINE_MIN_QUERY:
+        user_id = inline_query.from_user.id
+        previous = inline_searches.get(user_id)
+        if previous is not None:
+            previous.cancel()
+        task = inline_searches[user_id] = asyncio.create_task(run_inline_search(query))
+        try:
+            films = await task
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            # Пользователь успел набрать ещё: ответим уже на новый запрос
+            return
+        except QuotaExceeded:
+            films = []
+        finally:
+            if inline_searches.get(user_id) is task:
+                del inline_searches[user_id]
+    results = [inline_film_result(film) for film in films if film.get("kinopoiskId") and film.get("title")]
+    # Ответ на устаревший запрос Telegram отклоняет — это не ошибка
+    with suppress(TelegramBadRequest):
+        await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=button is not None, button=button)
+
+async def add_inline_film(kinopoisk_id, profile):
+    film = await get_film_details_kinopoisk(str(kinopoisk_id))
+    if not film:
+        return False
+    await add_film_from_kinopoisk(film, profile)
+    return True
+
+@dp.chosen_inline_result()
+async def inline_chosen(result: types.ChosenInlineResult, state: FSMContext):
+    # Приходит, только если у бота включён inline feedback (/setinlinefeedback в BotFather)
+    profile = current_profile(await state.get_data())
+    if not profile:
+        return
+    try:
+        await add_inline_film(result.result_id, profile)
+    except QuotaExceeded:
+        logger.warning("inline add skipped: kinopoisk quota exhausted user=%s", result.from_user.id)
+
+@dp.callback_query(F.data.startswith("inline_add_"))
+async def inline_add_callback(callback: types.CallbackQuery, state: FSMContext):
+    # Кнопка под карточкой, отправленной через inline: добавляет тому, кто нажал
+    profile = current_profile(await state.get_data())
+    if not profile:
+        await callback.answer("Сначала выберите пользователя через /start в чате с ботом.", show_alert=True)
+        return
+    try:
+        added = await add_inline_film(callback.data.rsplit("_", 1)[1], profile)
+    except QuotaExceeded:
+        await callback.answer(QUOTA_EXCEEDED_TEXT, show_alert=True)
+        return
+    if not added:
+        await callback.answer("Не удалось получить подробности фильма. Попробуйте позже.", show_alert=True)
+        return
+    await callback.answer("Фильм добавлен в вашу коллекцию!")
+
 @dp.message()
 async def handle_text(message: types.Message, state: FSMContext):
     data = await state.get_data()
-    if data.get("profile"):
+    if current_profile(data) is not None:
         await state.set_state(UserStates.user_selected)
-        await message.answer("Пожалуйста, используйте кнопки меню для управления ботом.", reply_markup=get_main_kb(data.get("profile")))
+        await message.answer("Пожалуйста, используйте кнопки меню для управления ботом.", reply_markup=get_main_kb())
     else:
         await message.answer("Сначала выберите пользователя через /start.")
 
+async def run_polling():
+    # Апдейты, обработанные до прошлой остановки, подтверждаем до старта polling,
+    # иначе Telegram пришлёт их снова (включая саму кнопку перезапуска)
+    offset = await load_offset(bot.id)
+    if offset is not None:
+        try:
+            await confirm_offset(bot, offset)
+        except TelegramAPIError as e:
+            logger.warning("polling offset confirm failed offset=%s error=%r", offset, e)
+    polling = asyncio.create_task(dp.start_polling(bot, close_bot_session=False))
+    stop = asyncio.create_task(stop_requested.wait())
+    await asyncio.wait({polling, stop}, return_when=asyncio.FIRST_COMPLETED)
+    stop.cancel()
+    if not polling.done():
+        await dp.stop_polling()
+    await polling
+    # Новые апдейты больше не забираются, дорабатываем уже начатые
+    await update_tracker.drain(SHUTDOWN_TIMEOUT)
+    offset = update_tracker.offset()
+    if offset is not None:
+        await save_offset(bot.id, offset)
+
+async def shutdown(metrics_runner):
+    # Сначала всё, что ещё пишет в базу через writer, потом сам writer
+    await metadata_refresher.stop()
+    await drain_background_tasks(SHUTDOWN_TIMEOUT)
+    await dp.storage.close()
+    await api_budget.flush()
+    await db_writer.close()
+    await kinopoisk_client.close()
+    await bot.session.close()
+    # Последнее соединение делает checkpoint и убирает WAL: следующему запуску нечего восстанавливать
+    await engine.dispose()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
 async def main():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    await dp.start_polling(bot)
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    # aiogram пишет INFO-строку на каждый апдейт; время хендлеров и так есть в /metrics
+    logging.getLogger("aiogram.event").setLevel(max(logging.getLevelName(LOG_LEVEL), logging.WARNING))
+    await migrate(engine)
+    await kinopoisk_client.start()
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    metadata_refresher.start()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, stop_requested)
+        else:
+            await run_polling()
+    finally:
+        await shutdown(metrics_runner)
+    if restart_requested:
+        logger.info("exiting for restart code=%s", RESTART_EXIT_CODE)
+        return RESTART_EXIT_CODE
+    return 0
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from dataclasses import make_dataclass, replace
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal
+from writer import db_writer
+from models import KinopoiskCache, COLLECTION_COLUMNS
+from ratelimit import Priority
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL = {
+    "search": int(os.getenv("CACHE_TTL_SEARCH", str(6 * 3600))),
+    "movie": int(os.getenv("CACHE_TTL_MOVIE", str(7 * 24 * 3600))),
+}
+CACHE_MEMORY_SIZE = int(os.getenv("CACHE_MEMORY_SIZE", "512"))
+CACHE_DISK_SIZE = int(os.getenv("CACHE_DISK_SIZE", "20000"))
+# Сколько хранить просроченные записи на диске: их отдаём, когда квота API на исходе
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", str(30 * 24 * 3600)))
+# Как часто (в записях) проверять размер таблицы на диске
+CACHE_PRUNE_EVERY = 200
+COLLECTION_CACHE_ENABLED = os.getenv("COLLECTION_CACHE_ENABLED", "1") == "1"
+COLLECTION_CACHE_PROFILES = int(os.getenv("COLLECTION_CACHE_PROFILES", "32"))
+COLLECTION_CACHE_MAX_FILMS = int(os.getenv("COLLECTION_CACHE_MAX_FILMS", "5000"))
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "2000"))
+INLINE_CACHE_TTL = int(os.getenv("INLINE_CACHE_TTL", "1800"))
+# Короче этого префикс слишком общий, чтобы отвечать его результатами
+INLINE_MIN_PREFIX = int(os.getenv("INLINE_MIN_PREFIX", "3"))
+
+# Неизменяемый снимок записи коллекции с данными каталога: в кэше не держим живые ORM-объекты
+FilmSnapshot = make_dataclass("FilmSnapshot", [column.name for column in COLLECTION_COLUMNS], frozen=True, slots=True)
+
+
+def normalize_query(query: str):
+    return " ".join(query.casefold().split())
+
+
+# В полнотекстовом поиске ё и е неразличимы: «крестный» находит «Крёстный отец».
+# Одна таблица замен и для текста запроса, и для SQL-выражений, которыми заполняется индекс
+YO_FOLDING = {"ё": "е", "Ё": "Е"}
+
+
+def fold_yo(text: str):
+    return text.translate(str.maketrans(YO_FOLDING))
+
+
+def fold_yo_sql(expr: str):
+    for letter, replacement in YO_FOLDING.items():
+        expr = f"replace({expr}, '{letter}', '{replacement}')"
+    return expr
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, now=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= (now or time.time()):
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def set(self, key, value, expires_at: float):
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache:
+    # Два уровня: LRU в памяти процесса и таблица kinopoisk_cache в films.db,
+    # которая переживает перезапуск бота.
+    def __init__(self, ttls=None, memory_size=CACHE_MEMORY_SIZE, disk_size=CACHE_DISK_SIZE):
+        self.ttls = dict(CACHE_TTL if ttls is None else ttls)
+        self.memory = LRUCache(memory_size)
+        self.disk_size = disk_size
+        self.hits = {"memory": 0, "disk": 0, "stale": 0}
+        self.misses = 0
+        self._writes = 0
+
+    async def get(self, kind: str, key: str, allow_stale=False):
+        now = time.time()
+        entry = self.memory.get((kind, key), now)
+        if entry is not None:
+            self.hits["memory"] += 1
+            return entry[1]
+        if allow_stale:
+            return await self._get_stale(kind, key)
+        try:
+            async with SessionLocal() as session:
+                row = await session.get(KinopoiskCache, (kind, key))
+        except Exception as e:
+            logger.warning("cache read error kind=%s key=%s error=%r", kind, key, e)
+            row = None
+        if row is not None and row.expires_at > now:
+            value = json.loads(row.value)
+            self.memory.set((kind, key), value, row.expires_at)
+            self.hits["disk"] += 1
+            return value
+        self.misses += 1
+        return None
+
+    async def _get_stale(self, kind: str, key: str):
+        try:
+            async with SessionLocal() as session:
+                row = await session.get(KinopoiskCache, (kind, key))
+        except Exception as e:
+            logger.warning("cache read error kind=%s key=%s error=%r", kind, key, e)
+            return None
+        if row is None:
+            return None
+        self.hits["stale"] += 1
+        return json.loads(row.value)
+
+    async def set(self, kind: str, key: str, value):
+        now = time.time()
+        expires_at = now + self.ttls.get(kind, 3600)
+        self.memory.set((kind, key), value, expires_at)
+        payload = json.dumps(value, ensure_ascii=False)
+        stmt = insert(KinopoiskCache).values(kind=kind, key=key, value=payload, expires_at=expires_at, updated_at=now)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[KinopoiskCache.kind, KinopoiskCache.key],
+            set_={"value": payload, "expires_at": expires_at, "updated_at": now},
+        )
+        # Запись на диск не задерживает ответ пользователю: она уходит в общую очередь writer'а
+        db_writer.submit_nowait(lambda session: session.execute(stmt))
+        self._writes += 1
+        if self._writes % CACHE_PRUNE_EVERY == 0:
+            db_writer.submit_nowait(self._prune)
+
+    async def _prune(self, session):
+        await session.execute(delete(KinopoiskCache).where(KinopoiskCache.expires_at <= time.time() - CACHE_STALE_TTL))
+        count = await session.scalar(select(func.count()).select_from(KinopoiskCache))
+        if count > self.disk_size:
+            oldest = select(KinopoiskCache.updated_at).order_by(KinopoiskCache.updated_at).offset(count - self.disk_size).limit(1)
+            await session.execute(delete(KinopoiskCache).where(KinopoiskCache.updated_at < oldest.scalar_subquery()))
+
+    async def prune(self):
+        await db_writer.submit(self._prune)
+
+    def stats(self):
+        hits = self.hits["memory"] + self.hits["disk"]
+        total = hits + self.misses
+        return {
+            "memory_hits": self.hits["memory"],
+            "disk_hits": self.hits["disk"],
+            "stale_hits": self.hits["stale"],
+            "misses": self.misses,
+            "hit_ratio": hits / total if total else 0.0,
+            "memory_size": len(self.memory),
+        }
+
+
+class SingleFlight:
+    # Одинаковые одновременные запросы (один и тот же фильм или поиск)
+    # схлопываются в одну задачу, остальные просто ждут её результат.
+    # С priority func получает последним аргументом общий Priority: запрос идёт
+    # с самым высоким приоритетом из тех, кто его ждёт
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func, *args, priority=None):
+        call = self._calls.get(key)
+        if call is None:
+            shared = Priority(priority) if priority is not None else None
+            task = asyncio.ensure_future(func(*args, shared) if shared is not None else func(*args))
+            call = self._calls[key] = (task, shared)
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        task, shared = call
+        if shared is not None and priority is not None:
+            shared.raise_to(priority)
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class PrefixCache:
+    # Результаты inline-поиска по мере набора: на «матри» можно сразу ответить
+    # тем, что уже нашлось для «матр», оставив фильмы, чьё название подходит
+    def __init__(self, maxsize=INLINE_CACHE_SIZE, ttl=INLINE_CACHE_TTL, min_prefix=INLINE_MIN_PREFIX):
+        self.ttl = ttl
+        self.min_prefix = min_prefix
+        self._entries = LRUCache(maxsize)
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+
+    def get(self, query: str):
+        query = normalize_query(query)
+        entry = self._entries.get(query)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        for end in range(len(query) - 1, self.min_prefix - 1, -1):
+            entry = self._entries.get(query[:end])
+            if entry is None:
+                continue
+            matched = [film for film in entry[1] if query in normalize_query(film.get("title") or "")]
+            if matched:
+                self.prefix_hits += 1
+                return matched
+        self.misses += 1
+        return None
+
+    def set(self, query: str, films):
+        self._entries.set(normalize_query(query), films, time.time() + self.ttl)
+
+
+class ProfileCollection:
+    def __init__(self, films):
+        self.films = films
+        self.by_id = {film.id: film for film in films}
+        self._views = {}
+
+    def _view(self, watched):
+        view = self._views.get(watched)
+        if view is None:
+            films = self.films if watched is None else [film for film in self.films if bool(film.watched) == watched]
+            view = self._views[watched] = (films, [film.id for film in films])
+        return view
+
+    def filter(self, watched=None):
+        return self._view(watched)[0]
+
+    def page(self, after_id=None, before_id=None, watched=None, limit=10):
+        # Та же семантика, что у keyset-запроса в services.get_films_page
+        films, ids = self._view(watched)
+        if before_id is not None:
+            end = bisect_left(ids, before_id)
+            start = max(0, end - limit)
+            return films[start:end], start > 0, True
+        start = bisect_right(ids, after_id) if after_id is not None else 0
+        return films[start:start + limit], after_id is not None, start + limit < len(films)
+
+
+class CollectionCache:
+    # Read-through кэш коллекций по профилям. Данные в films меняются только
+    # через функции services.py, и каждая из них обновляет или сбрасывает кэш.
+    def __init__(self, enabled=COLLECTION_CACHE_ENABLED, max_profiles=COLLECTION_CACHE_PROFILES,
+                 max_films=COLLECTION_CACHE_MAX_FILMS):
+        self.enabled = enabled
+        self.max_profiles = max_profiles
+        self.max_films = max_films
+        self._entries = OrderedDict()
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, profile: str, loader):
+        if not self.enabled:
+            return None
+        entry = self._entries.get(profile)
+        if entry is not None:
+            self._entries.move_to_end(profile)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        generation = self._generations.get(profile, 0)
+        films = await loader(profile, self.max_films)
+        if films is None:
+            return None
+        entry = ProfileCollection(films)
+        # Пока грузили, профиль успели изменить — такой снимок уже устарел
+        if self._generations.get(profile, 0) == generation:
+            self._entries[profile] = entry
+            while len(self._entries) > self.max_profiles:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, profile: str):
+        self._generations[profile] = self._generations.get(profile, 0) + 1
+        self._entries.pop(profile, None)
+
+    def update_film(self, profile: str, film_id: int, **changes):
+        self._generations[profile] = self._generations.get(profile, 0) + 1
+        entry = self._entries.get(profile)
+        if entry is None or film_id not in entry.by_id:
+            return
+        self._entries[profile] = ProfileCollection([
+            replace(film, **changes) if film.id == film_id else film for film in entry.films
+        ])
+
+    def update_catalog_film(self, film_id: int, **changes):
+        # Метаданные общие: фильм каталога меняется во всех коллекциях, где он лежит
+        for profile, entry in list(self._entries.items()):
+            if any(film.film_id == film_id for film in entry.films):
+                self._generations[profile] = self._generations.get(profile, 0) + 1
+                self._entries[profile] = ProfileCollection([
+                    replace(film, **changes) if film.film_id == film_id else film for film in entry.films
+                ])
+
+    def remove_film(self, profile: str, film_id: int):
+        self._generations[profile] = self._generations.get(profile, 0) + 1
+        entry = self._entries.get(profile)
+        if entry is None or film_id not in entry.by_id:
+            return
+        self._entries[profile] = ProfileCollection([film for film in entry.films if film.id != film_id])
+
+    def clear(self):
+        for profile in list(self._entries):
+            self.invalidate(profile)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "profiles": len(self._entries),
+        }
+
+
+response_cache = ResponseCache()
+collection_cache = CollectionCache()
+inline_cache = PrefixCache()
@@ -5,4 +5,33 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
-    raise ValueError("Не найден токен бота. Создайте файл .env и добавьте в него BOT_TOKEN=ваш_токен") 
\ No newline at end of file
+    raise ValueError("Не найден токен бота. Создайте файл .env и добавьте в него BOT_TOKEN=ваш_токен") 
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Prometheus-метрики на http://METRICS_HOST:METRICS_PORT/metrics. По умолчанию выключены (0);
+# слушают только localhost — наружу открывать явно, через METRICS_HOST=0.0.0.0
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Свой сервер Bot API (локальный telegram-bot-api или фейковый из bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Режим получения апдейтов: "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("Для BOT_MODE=webhook укажите в .env WEBHOOK_URL=https://ваш_домен")
+
+# Telegram id администраторов через запятую: только им доступен перезапуск из меню
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").replace(",", " ").split()}
+# Сколько ждать завершения начатых апдейтов при остановке, с
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "10"))
+# Код выхода после перезапуска из меню: supervisor/systemd (Restart=on-failure) поднимет бота заново
+RESTART_EXIT_CODE = int(os.getenv("RESTART_EXIT_CODE", "75"))
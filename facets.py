@@ -0,0 +1,82 @@
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert
+from models import Film, UserFilm, Genre, Person, Country, FilmGenre, FilmPerson, FilmCountry
+
+# facet -> (справочник, таблица связей, колонка ссылки, роль персоны)
+FACETS = {
+    "genre": (Genre, FilmGenre, "genre_id", None),
+    "director": (Person, FilmPerson, "person_id", "director"),
+    "actor": (Person, FilmPerson, "person_id", "actor"),
+    "country": (Country, FilmCountry, "country_id", None),
+}
+
+
+def split_names(value):
+    return [name.strip() for name in value.split(",") if name.strip()] if value else []
+
+
+def facet_values(film_data: dict):
+    # Списки приходят из get_film_details_kinopoisk; для старых записей
+    # (и старых ответов в кэше) разбираем строки через запятую
+    return {
+        "genre": film_data.get("genres") or split_names(film_data.get("genre")),
+        "director": film_data.get("directors") or split_names(film_data.get("director")),
+        "actor": film_data.get("cast") or split_names(film_data.get("actors")),
+        "country": film_data.get("countries") or split_names(film_data.get("country")),
+    }
+
+
+async def replace_film_facets(conn, film_id: int, values: dict):
+    # conn — AsyncSession или AsyncConnection внутри уже открытой транзакции
+    for link in (FilmGenre, FilmPerson, FilmCountry):
+        await conn.execute(delete(link.__table__).where(link.__table__.c.film_id == film_id))
+    for facet, names in values.items():
+        names = list(dict.fromkeys(names))
+        if not names:
+            continue
+        lookup, link, column, role = FACETS[facet]
+        await conn.execute(insert(lookup.__table__).on_conflict_do_nothing(), [{"name": name} for name in names])
+        result = await conn.execute(select(lookup.__table__.c.name, lookup.__table__.c.id).where(lookup.__table__.c.name.in_(names)))
+        ids = dict(result.all())
+        rows = [{"film_id": film_id, column: ids[name]} for name in names]
+        if role:
+            for row in rows:
+                row["role"] = role
+        await conn.execute(insert(link.__table__).on_conflict_do_nothing(), rows)
+
+
+def facet_condition(facet: str, value_id: int):
+    _, link, column, role = FACETS[facet]
+    films = select(link.film_id).where(getattr(link, column) == value_id)
+    if role:
+        films = films.where(link.role == role)
+    return UserFilm.film_id.in_(films)
+
+
+def filter_conditions(filters: dict):
+    conditions = []
+    for facet in FACETS:
+        selected = filters.get(facet)
+        if selected:
+            conditions.append(facet_condition(facet, selected[0]))
+    if filters.get("year_from"):
+        conditions.append(Film.year >= filters["year_from"])
+    if filters.get("year_to"):
+        conditions.append(Film.year <= filters["year_to"])
+    if filters.get("watched") is not None:
+        conditions.append(UserFilm.watched == filters["watched"])
+    return conditions
+
+
+def facet_options_query(facet: str, profile: int, limit: int):
+    lookup, link, column, role = FACETS[facet]
+    count = func.count(link.film_id)
+    query = (
+        select(lookup.id, lookup.name, count)
+        .join(link, getattr(link, column) == lookup.id)
+        .join(UserFilm, UserFilm.film_id == link.film_id)
+        .where(UserFilm.user_id == profile)
+    )
+    if role:
+        query = query.where(link.role == role)
+    return query.group_by(lookup.id).order_by(count.desc(), lookup.name).limit(limit)
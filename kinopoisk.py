@@ -0,0 +1,105 @@
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+import aiohttp
+from urllib.parse import urlsplit
+from ratelimit import api_budget, INTERACTIVE
+from metrics import KINOPOISK_LATENCY
+
+logger = logging.getLogger(__name__)
+
+KINOPOISK_API_TOKEN = os.getenv("KINOPOISK_API_TOKEN") or "ACTXDM9-R3M4XBF-NDSC4BB-BPMF9BN"
+KINOPOISK_CONNECT_TIMEOUT = float(os.getenv("KINOPOISK_CONNECT_TIMEOUT", "5"))
+KINOPOISK_TOTAL_TIMEOUT = float(os.getenv("KINOPOISK_TOTAL_TIMEOUT", "10"))
+KINOPOISK_MAX_CONNECTIONS = int(os.getenv("KINOPOISK_MAX_CONNECTIONS", "20"))
+KINOPOISK_MAX_PER_HOST = int(os.getenv("KINOPOISK_MAX_PER_HOST", "10"))
+KINOPOISK_KEEPALIVE = float(os.getenv("KINOPOISK_KEEPALIVE", "60"))
+KINOPOISK_RETRIES = int(os.getenv("KINOPOISK_RETRIES", "3"))
+KINOPOISK_BACKOFF_BASE = float(os.getenv("KINOPOISK_BACKOFF_BASE", "0.5"))
+KINOPOISK_BACKOFF_MAX = float(os.getenv("KINOPOISK_BACKOFF_MAX", "8"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class KinopoiskClient:
+    # Одна долгоживущая сессия на весь процесс: соединения с api.kinopoisk.dev
+    # переиспользуются (keep-alive), вместо нового TCP/TLS на каждый запрос.
+    def __init__(self, token=KINOPOISK_API_TOKEN, connect_timeout=KINOPOISK_CONNECT_TIMEOUT,
+                 total_timeout=KINOPOISK_TOTAL_TIMEOUT, limit=KINOPOISK_MAX_CONNECTIONS,
+                 limit_per_host=KINOPOISK_MAX_PER_HOST, keepalive=KINOPOISK_KEEPALIVE,
+                 retries=KINOPOISK_RETRIES, backoff_base=KINOPOISK_BACKOFF_BASE,
+                 backoff_max=KINOPOISK_BACKOFF_MAX, budget=api_budget):
+        self.token = token
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.budget = budget
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"X-API-KEY": self.token},
+            )
+        return self
+
+    async def close(self):
+        await self.budget.flush()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # Экспоненциальная задержка с "full jitter"
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def get_json(self, url: str, params=None, timeout=None, priority=INTERACTIVE):
+        await self.start()
+        # /v1.4/movie/326 -> /v1.4/movie/{id}: одна серия метрик на эндпоинт
+        endpoint = re.sub(r"/\d+", "/{id}", urlsplit(url).path)
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            # Каждая попытка (включая повторы) расходует токен и суточную квоту
+            await self.budget.acquire(priority)
+            started = time.perf_counter()
+            try:
+                async with self._session.get(url, params=params, timeout=timeout) as resp:
+                    KINOPOISK_LATENCY.observe(time.perf_counter() - started, endpoint, resp.status)
+                    if resp.status == 200:
+                        return await resp.json()
+                    if resp.status in RETRY_STATUSES and not last:
+                        retry_after = resp.headers.get("Retry-After")
+                        delay = self._backoff(attempt, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                        if resp.status == 429:
+                            self.budget.penalize(delay)
+                        await asyncio.sleep(delay)
+                        continue
+                    logger.warning("kinopoisk error endpoint=%s status=%s", endpoint, resp.status)
+                    return None
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                KINOPOISK_LATENCY.observe(time.perf_counter() - started, endpoint, "error")
+                if last:
+                    logger.warning("kinopoisk request failed endpoint=%s error=%r", endpoint, e)
+                    return None
+                await asyncio.sleep(self._backoff(attempt))
+        return None
+
+
+kinopoisk_client = KinopoiskClient()
@@ -0,0 +1,211 @@
+from sqlalchemy import select
+from database import Base
+from models import Film, UserFilm, PollingState, CollectionShare
+from facets import facet_values, replace_film_facets
+from cache import normalize_query, fold_yo_sql
+
+
+async def _column_exists(conn, table: str, column: str):
+    result = await conn.exec_driver_sql(f"PRAGMA table_info({table})")
+    return any(row[1] == column for row in result)
+
+
+async def _table_exists(conn, table: str):
+    result = await conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return result.first() is not None
+
+
+async def _add_column(conn, table: str, column: str, ddl: str):
+    if not await _column_exists(conn, table, column):
+        await conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+async def _films_kinopoisk_id(conn):
+    await _add_column(conn, "films", "kinopoisk_id", "INTEGER")
+    # Оставляем по одной записи на (profile, kinopoisk_id), иначе уникальный индекс не создастся
+    await conn.exec_driver_sql(
+        "DELETE FROM films WHERE kinopoisk_id IS NOT NULL AND id NOT IN "
+        "(SELECT MIN(id) FROM films WHERE kinopoisk_id IS NOT NULL GROUP BY profile, kinopoisk_id)"
+    )
+    await conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_films_profile_kinopoisk ON films (profile, kinopoisk_id)"
+    )
+
+
+async def _films_list_indexes(conn):
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_films_profile_id ON films (profile, id)")
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_films_profile_watched ON films (profile, watched, id)")
+
+
+FTS_COLUMNS = ("title", "description", "director", "actors", "genre")
+
+
+async def _create_fts(conn):
+    # Полнотекстовый индекс по своей коллекции; синхронизируется триггерами,
+    # поэтому любые записи в films (в том числе upsert) сразу видны в поиске.
+    # Индексируется представление с ё, заменённой на е: из него же читают 'rebuild'
+    # и 'integrity-check', а триггеры пишут в индекс те же выражения
+    columns = ", ".join(FTS_COLUMNS)
+    await conn.exec_driver_sql(
+        f"CREATE VIEW IF NOT EXISTS films_fts_content AS SELECT id, "
+        + ", ".join(f"{fold_yo_sql(column)} AS {column}" for column in FTS_COLUMNS)
+        + " FROM films"
+    )
+    await conn.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS films_fts USING fts5("
+        f"{columns}, "
+        "content='films_fts_content', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+    )
+    old_values = ", ".join(fold_yo_sql(f"old.{column}") for column in FTS_COLUMNS)
+    new_values = ", ".join(fold_yo_sql(f"new.{column}") for column in FTS_COLUMNS)
+    await conn.exec_driver_sql(
+        f"CREATE TRIGGER IF NOT EXISTS films_fts_ai AFTER INSERT ON films BEGIN "
+        f"INSERT INTO films_fts(rowid, {columns}) VALUES (new.id, {new_values}); END"
+    )
+    await conn.exec_driver_sql(
+        f"CREATE TRIGGER IF NOT EXISTS films_fts_ad AFTER DELETE ON films BEGIN "
+        f"INSERT INTO films_fts(films_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); END"
+    )
+    await conn.exec_driver_sql(
+        f"CREATE TRIGGER IF NOT EXISTS films_fts_au AFTER UPDATE OF {columns} ON films BEGIN "
+        f"INSERT INTO films_fts(films_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values}); "
+        f"INSERT INTO films_fts(rowid, {columns}) VALUES (new.id, {new_values}); END"
+    )
+
+
+async def _films_fts(conn):
+    await _create_fts(conn)
+    await conn.exec_driver_sql("INSERT INTO films_fts(films_fts) VALUES ('rebuild')")
+
+
+async def _create_facet_triggers(conn):
+    # Внешние ключи в SQLite не включены, поэтому связи удаляем триггером
+    await conn.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS films_facets_ad AFTER DELETE ON films BEGIN "
+        "DELETE FROM film_genres WHERE film_id = old.id; "
+        "DELETE FROM film_persons WHERE film_id = old.id; "
+        "DELETE FROM film_countries WHERE film_id = old.id; END"
+    )
+
+
+async def _film_facets(conn):
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_films_profile_year ON films (profile, year)")
+    await _create_facet_triggers(conn)
+    result = await conn.execute(select(Film.id, Film.genre, Film.director, Film.actors, Film.country))
+    for row in result.all():
+        values = facet_values({"genre": row.genre, "director": row.director, "actors": row.actors, "country": row.country})
+        await replace_film_facets(conn, row.id, values)
+
+
+# Только добавлять в конец: номер миграции = её позиция в списке (PRAGMA user_version)
+async def _films_poster_file_id(conn):
+    await _add_column(conn, "films", "poster_file_id", "VARCHAR")
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_films_kinopoisk ON films (kinopoisk_id)")
+
+
+async def _films_refreshed_at(conn):
+    await _add_column(conn, "films", "refreshed_at", "FLOAT")
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_films_refreshed ON films (refreshed_at)")
+
+
+async def _shared_catalog(conn):
+    # films становится общим каталогом (одна строка на kinopoisk_id), а отметки,
+    # оценки и комментарии переезжают в user_films. Старая пустая user_films пересоздаётся.
+    # Именные профили получают отрицательные id, пока их не займут через /start.
+    await conn.exec_driver_sql(
+        "INSERT INTO profiles (user_id, name) "
+        "SELECT -ROW_NUMBER() OVER (ORDER BY MIN(id)), profile FROM films GROUP BY profile"
+    )
+    await conn.exec_driver_sql("DROP TABLE IF EXISTS user_films")
+    await conn.run_sync(UserFilm.__table__.create)
+    # Один фильм в каталоге: по kinopoisk_id, а у старых записей без него — по названию и году.
+    # Сравниваем в Python: lower() в SQLite не знает кириллицы
+    canonical, catalog = {}, []
+    for film_id, title, year, kinopoisk_id in await conn.execute(
+        select(Film.id, Film.title, Film.year, Film.kinopoisk_id).order_by(Film.id)
+    ):
+        key = ("kinopoisk", kinopoisk_id) if kinopoisk_id is not None else ("title", normalize_query(title or ""), year)
+        catalog.append((film_id, canonical.setdefault(key, film_id)))
+    await conn.exec_driver_sql("CREATE TEMP TABLE catalog_ids (id INTEGER PRIMARY KEY, film_id INTEGER NOT NULL)")
+    if catalog:
+        await conn.exec_driver_sql("INSERT INTO catalog_ids (id, film_id) VALUES (?, ?)", catalog)
+    # id записей коллекции совпадают со старыми id фильмов: кнопки в старых сообщениях продолжают работать.
+    # Старая версия позволяла добавить фильм в профиль дважды — такие записи сливаются в одну:
+    # просмотрен, если отмечен хоть раз, оценка и комментарий — из той, где они есть
+    await conn.exec_driver_sql(
+        "INSERT INTO user_films (id, user_id, film_id, watched, rating_user, comment_user) "
+        "SELECT MIN(films.id), profiles.user_id, catalog_ids.film_id, MAX(films.watched), MAX(films.rating_user), MAX(films.comment_user) "
+        "FROM films JOIN profiles ON profiles.name = films.profile JOIN catalog_ids ON catalog_ids.id = films.id "
+        "GROUP BY profiles.user_id, catalog_ids.film_id"
+    )
+    await conn.exec_driver_sql("DROP TABLE catalog_ids")
+    await conn.exec_driver_sql("DELETE FROM films WHERE id NOT IN (SELECT film_id FROM user_films)")
+    for index in ("uq_films_profile_kinopoisk", "ix_films_profile_id", "ix_films_profile_watched", "ix_films_profile_year", "ix_films_kinopoisk"):
+        await conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index}")
+    for column in ("profile", "watched", "rating_user", "comment_user"):
+        await conn.exec_driver_sql(f"ALTER TABLE films DROP COLUMN {column}")
+    await conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ux_films_kinopoisk ON films (kinopoisk_id)")
+    await conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_films_year ON films (year)")
+
+
+async def _polling_state(conn):
+    await conn.run_sync(PollingState.__table__.create, checkfirst=True)
+
+
+async def _collection_shares(conn):
+    await _add_column(conn, "profiles", "share_code", "VARCHAR")
+    await conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ux_profiles_share_code ON profiles (share_code)")
+    await conn.run_sync(CollectionShare.__table__.create, checkfirst=True)
+    # Старые именные коллекции и раньше были видны друг другу — сохраняем это как взаимный доступ
+    await conn.exec_driver_sql(
+        "INSERT OR IGNORE INTO collection_shares (owner_id, viewer_id) "
+        "SELECT owner.user_id, viewer.user_id FROM profiles AS owner JOIN profiles AS viewer "
+        "ON owner.user_id != viewer.user_id WHERE owner.user_id < 0 AND viewer.user_id < 0"
+    )
+
+
+
+async def _films_fts_yo(conn):
+    # Старый индекс брал текст из films как есть — пересоздаём его поверх представления с ё → е
+    for trigger in ("films_fts_ai", "films_fts_ad", "films_fts_au"):
+        await conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+    await conn.exec_driver_sql("DROP TABLE IF EXISTS films_fts")
+    await conn.exec_driver_sql("DROP VIEW IF EXISTS films_fts_content")
+    await _create_fts(conn)
+    await conn.exec_driver_sql("INSERT INTO films_fts(films_fts) VALUES ('rebuild')")
+
+MIGRATIONS = [
+    _films_kinopoisk_id,
+    _films_list_indexes,
+    _films_fts,
+    _film_facets,
+    _films_poster_file_id,
+    _films_refreshed_at,
+    _shared_catalog,
+    _polling_state,
+    _collection_shares,
+    _films_fts_yo,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def migrate(engine):
+    async with engine.begin() as conn:
+        version = (await conn.exec_driver_sql("PRAGMA user_version")).scalar()
+        if version == SCHEMA_VERSION:
+            # Схема не менялась с прошлого запуска — create_all с PRAGMA table_info по каждой
+            # таблице не нужен. Поэтому новая таблица в моделях всегда приходит вместе с миграцией.
+            return SCHEMA_VERSION
+        fresh = not await _table_exists(conn, "films")
+        # Новые таблицы создаются сразу в актуальном виде, миграции догоняют старые базы
+        await conn.run_sync(Base.metadata.create_all)
+        if fresh:
+            # Пустой базе миграции данных не нужны — только то, чего нет в моделях
+            await _create_fts(conn)
+            await _create_facet_triggers(conn)
+            await conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            return SCHEMA_VERSION
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            await migration(conn)
+            await conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+    return SCHEMA_VERSION
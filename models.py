@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, Index
 from database import Base
 
 class Film(Base):
+    # Общий каталог: одна запись на фильм Кинопоиска, сколько бы коллекций его ни содержали
     __tablename__ = "films"
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
@@ -15,13 +16,120 @@ class Film(Base):
     actors = Column(String)
     country = Column(String)
     rating = Column(String)
+    kinopoisk_id = Column(Integer)
+    # file_id постера в Telegram: после первой загрузки фото отправляется без скачивания
+    poster_file_id = Column(String)
+    # Когда метаданные (рейтинг, ссылки) последний раз сверялись с Кинопоиском
+    refreshed_at = Column(Float)
+
+    __table_args__ = (
+        Index("ux_films_kinopoisk", "kinopoisk_id", unique=True),
+        Index("ix_films_year", "year"),
+        Index("ix_films_refreshed", "refreshed_at"),
+    )
+
+class Profile(Base):
+    __tablename__ = "profiles"
+    # Telegram user_id владельца коллекции. Старые именные профили, которые
+    # ещё никто не занял через /start, хранятся с отрицательным id
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String, nullable=False)
+    # Код из ссылки-приглашения t.me/<бот>?start=share_<код>, создаётся по запросу
+    share_code = Column(String)
+
+    __table_args__ = (
+        Index("ux_profiles_share_code", "share_code", unique=True),
+    )
+
+class CollectionShare(Base):
+    # viewer видит коллекцию owner: доступ даёт сам владелец ссылкой-приглашением
+    __tablename__ = "collection_shares"
+    owner_id = Column(Integer, primary_key=True, autoincrement=False)
+    viewer_id = Column(Integer, primary_key=True, autoincrement=False)
+
+    __table_args__ = (
+        Index("ix_collection_shares_viewer", "viewer_id"),
+    )
+
+class UserFilm(Base):
+    # Фильм в коллекции пользователя: только то, что у каждого своё
+    __tablename__ = "user_films"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    film_id = Column(Integer, ForeignKey("films.id"), nullable=False)
     watched = Column(Boolean, default=False)
-    profile = Column(String, nullable=False)
     rating_user = Column(Integer)
     comment_user = Column(String)
 
-class UserFilm(Base):
-    __tablename__ = "user_films"
+    __table_args__ = (
+        Index("uq_user_films_user_film", "user_id", "film_id", unique=True),
+        Index("ix_user_films_user_id", "user_id", "id"),
+        Index("ix_user_films_user_watched", "user_id", "watched", "id"),
+        Index("ix_user_films_film", "film_id"),
+    )
+
+# Запись коллекции вместе с метаданными из каталога; id — это id в user_films
+COLLECTION_COLUMNS = [*UserFilm.__table__.columns, *(column for column in Film.__table__.columns if column.name != "id")]
+
+class KinopoiskCache(Base):
+    __tablename__ = "kinopoisk_cache"
+    kind = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(String, nullable=False)
+    expires_at = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False, index=True)
+
+class ApiQuota(Base):
+    __tablename__ = "api_quota"
+    day = Column(String, primary_key=True)
+    used = Column(Integer, nullable=False, default=0)
+
+class FsmState(Base):
+    __tablename__ = "fsm_states"
+    key = Column(String, primary_key=True)
+    state = Column(String)
+    data = Column(String, nullable=False, default="{}")
+    updated_at = Column(Float, nullable=False)
+
+class PollingState(Base):
+    __tablename__ = "polling_state"
+    bot_id = Column(Integer, primary_key=True, autoincrement=False)
+    offset = Column(Integer, nullable=False)
+    updated_at = Column(Float, nullable=False)
+
+class Genre(Base):
+    __tablename__ = "genres"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+class Person(Base):
+    __tablename__ = "persons"
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+class Country(Base):
+    __tablename__ = "countries"
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer)
-    film_id = Column(Integer, ForeignKey("films.id")) 
\ No newline at end of file
+    name = Column(String, nullable=False, unique=True)
+
+class FilmGenre(Base):
+    __tablename__ = "film_genres"
+    film_id = Column(Integer, ForeignKey("films.id"), primary_key=True)
+    genre_id = Column(Integer, ForeignKey("genres.id"), primary_key=True)
+
+    __table_args__ = (Index("ix_film_genres_genre", "genre_id", "film_id"),)
+
+class FilmPerson(Base):
+    __tablename__ = "film_persons"
+    film_id = Column(Integer, ForeignKey("films.id"), primary_key=True)
+    person_id = Column(Integer, ForeignKey("persons.id"), primary_key=True)
+    role = Column(String, primary_key=True)
+
+    __table_args__ = (Index("ix_film_persons_person", "person_id", "role", "film_id"),)
+
+class FilmCountry(Base):
+    __tablename__ = "film_countries"
+    film_id = Column(Integer, ForeignKey("films.id"), primary_key=True)
+    country_id = Column(Integer, ForeignKey("countries.id"), primary_key=True)
+
+    __table_args__ = (Index("ix_film_countries_country", "country_id", "film_id"),)
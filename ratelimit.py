@@ -0,0 +1,170 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal
+from writer import db_writer
+from models import ApiQuota
+
+logger = logging.getLogger(__name__)
+
+KINOPOISK_RATE = float(os.getenv("KINOPOISK_RATE", "5"))
+KINOPOISK_BURST = int(os.getenv("KINOPOISK_BURST", "10"))
+KINOPOISK_DAILY_QUOTA = int(os.getenv("KINOPOISK_DAILY_QUOTA", "200"))
+# Доля суточной квоты, которую фоновые задачи не трогают
+KINOPOISK_BACKGROUND_RESERVE = float(os.getenv("KINOPOISK_BACKGROUND_RESERVE", "0.25"))
+# Ниже этой доли остатка бот сначала отдаёт устаревший кэш, а уже потом идёт в сеть
+KINOPOISK_LOW_WATERMARK = float(os.getenv("KINOPOISK_LOW_WATERMARK", "0.1"))
+# Сброс квоты kinopoisk.dev происходит по московскому времени
+KINOPOISK_QUOTA_UTC_OFFSET = int(os.getenv("KINOPOISK_QUOTA_UTC_OFFSET", "3"))
+QUOTA_FLUSH_EVERY = 10
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class Priority:
+    # Общий приоритет запроса, который ждут несколько вызывающих (SingleFlight):
+    # если к фоновому префетчу присоединился пользователь, запрос становится интерактивным
+    def __init__(self, level=INTERACTIVE):
+        self.level = level
+
+    def raise_to(self, level):
+        self.level = min(self.level, level)
+
+
+def priority_level(priority):
+    return getattr(priority, "level", priority)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._waiters = []
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority=INTERACTIVE):
+        # Приоритеты ждущих читаются при каждой проверке: фоновый запрос, к которому
+        # присоединился пользователь, сразу считается интерактивным
+        self._waiters.append(priority)
+        try:
+            while True:
+                self._refill()
+                # Фоновые запросы уступают, пока кто-то из пользователей ждёт токен
+                blocked = priority_level(priority) != INTERACTIVE and any(
+                    priority_level(waiter) == INTERACTIVE for waiter in self._waiters
+                )
+                if not blocked and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max(1 - self.tokens, 0.1) / self.rate)
+        finally:
+            self._waiters.remove(priority)
+
+    def penalize(self, seconds: float):
+        # Сервер ответил 429: уводим ведро в минус, чтобы притормозить всех
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class DailyQuota:
+    def __init__(self, limit: int, background_reserve: float, utc_offset: int):
+        self.limit = limit
+        self.background_reserve = int(limit * background_reserve)
+        self.tz = timezone(timedelta(hours=utc_offset))
+        self.day = None
+        self.used = 0
+        self._unsaved = 0
+        self._lock = asyncio.Lock()
+
+    def today(self):
+        return datetime.now(self.tz).date().isoformat()
+
+    async def ensure_day(self):
+        day = self.today()
+        if day == self.day:
+            return
+        async with self._lock:
+            if day == self.day:
+                return
+            if self.day is not None and self._unsaved:
+                await self.flush()
+            try:
+                async with SessionLocal() as session:
+                    row = await session.get(ApiQuota, day)
+                used = row.used if row else 0
+            except Exception as e:
+                logger.warning("quota read error day=%s error=%r", day, e)
+                used = 0
+            self.day = day
+            self.used = used
+            self._unsaved = 0
+
+    @property
+    def remaining(self):
+        return max(self.limit - self.used, 0)
+
+    async def consume(self, priority=INTERACTIVE):
+        await self.ensure_day()
+        floor = self.background_reserve if priority_level(priority) != INTERACTIVE else 0
+        if self.remaining <= floor:
+            raise QuotaExceeded(f"Kinopoisk daily quota exhausted ({self.used}/{self.limit})")
+        self.used += 1
+        self._unsaved += 1
+        if self._unsaved >= QUOTA_FLUSH_EVERY:
+            await self.flush()
+
+    async def flush(self):
+        if self.day is None or not self._unsaved:
+            return
+        stmt = insert(ApiQuota).values(day=self.day, used=self.used)
+        stmt = stmt.on_conflict_do_update(index_elements=[ApiQuota.day], set_={"used": stmt.excluded.used})
+        try:
+            await db_writer.submit(lambda session: session.execute(stmt))
+            self._unsaved = 0
+        except Exception as e:
+            logger.warning("quota write error day=%s error=%r", self.day, e)
+
+
+class ApiBudget:
+    def __init__(self, rate=KINOPOISK_RATE, burst=KINOPOISK_BURST, daily_limit=KINOPOISK_DAILY_QUOTA,
+                 background_reserve=KINOPOISK_BACKGROUND_RESERVE, low_watermark=KINOPOISK_LOW_WATERMARK,
+                 utc_offset=KINOPOISK_QUOTA_UTC_OFFSET):
+        self.bucket = TokenBucket(rate, burst)
+        self.quota = DailyQuota(daily_limit, background_reserve, utc_offset)
+        self.low_watermark = int(daily_limit * low_watermark)
+
+    async def acquire(self, priority=INTERACTIVE):
+        await self.quota.consume(priority)
+        await self.bucket.acquire(priority)
+
+    async def nearly_exhausted(self):
+        await self.quota.ensure_day()
+        return self.quota.remaining <= self.low_watermark
+
+    async def background_headroom(self):
+        # Сколько запросов фоновые задачи могут потратить, не трогая резерв пользователей
+        await self.quota.ensure_day()
+        return self.quota.remaining - self.quota.background_reserve
+
+    def penalize(self, seconds: float):
+        self.bucket.penalize(seconds)
+
+    async def flush(self):
+        await self.quota.flush()
+
+
+api_budget = ApiBudget()
@@ -0,0 +1,199 @@
+import asyncio
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+from database import SessionLocal
+from models import Film, UserFilm, FilmGenre, FilmPerson, FilmCountry
+
+# Вес каждой группы признаков в векторе фильма
+FEATURE_WEIGHTS = {"genre": 1.0, "director": 1.5, "actor": 0.5, "country": 0.3, "decade": 0.5}
+# Небольшая добавка за рейтинг Кинопоиска: при равном сходстве выше идут фильмы получше
+RATING_PRIOR = 0.1
+# Просмотренный, но не оценённый фильм немного сдвигает вкус в свою сторону
+WATCHED_WEIGHT = 0.3
+
+
+def _parse_rating(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class Recommender:
+    # Признаки считаются один раз на фильм каталога, строки матрицы — записи коллекций.
+    # CSR-матрица пересобирается только после добавления/удаления записей. Оценки
+    # и отметки о просмотре меняют лишь массивы метаданных на месте, так что
+    # запрос — это пара умножений sparse × dense.
+    def __init__(self):
+        self.vocab = {}
+        self.features = {}
+        self.meta = {}
+        self._lock = asyncio.Lock()
+        self._loaded = False
+        self._dirty = True
+        self._matrix = None
+        self._entry_ids = []
+        self._index = {}
+        self._profiles = {}
+
+    def _features(self, year, links):
+        features = {}
+        for group, value in links:
+            column = self.vocab.setdefault((group, value), len(self.vocab))
+            features[column] = FEATURE_WEIGHTS[group]
+        if year:
+            column = self.vocab.setdefault(("decade", year // 10 * 10), len(self.vocab))
+            features[column] = FEATURE_WEIGHTS["decade"]
+        if not features:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        indices = np.fromiter(features.keys(), dtype=np.int32)
+        values = np.fromiter(features.values(), dtype=np.float32)
+        return indices, values / np.linalg.norm(values)
+
+    async def _load(self, film_ids=None):
+        # film_ids — id фильмов каталога: перечитываются их признаки и все записи с ними
+        films = select(Film.id, Film.year, Film.rating)
+        entries = select(UserFilm.id, UserFilm.user_id, UserFilm.film_id, UserFilm.watched, UserFilm.rating_user)
+        genres = select(FilmGenre.film_id, FilmGenre.genre_id)
+        persons = select(FilmPerson.film_id, FilmPerson.person_id, FilmPerson.role)
+        countries = select(FilmCountry.film_id, FilmCountry.country_id)
+        if film_ids is not None:
+            films = films.where(Film.id.in_(film_ids))
+            entries = entries.where(UserFilm.film_id.in_(film_ids))
+            genres = genres.where(FilmGenre.film_id.in_(film_ids))
+            persons = persons.where(FilmPerson.film_id.in_(film_ids))
+            countries = countries.where(FilmCountry.film_id.in_(film_ids))
+        async with SessionLocal() as session:
+            film_rows = (await session.execute(films)).all()
+            entry_rows = (await session.execute(entries)).all()
+            links = {}
+            for film_id, genre_id in (await session.execute(genres)).all():
+                links.setdefault(film_id, []).append(("genre", genre_id))
+            for film_id, person_id, role in (await session.execute(persons)).all():
+                links.setdefault(film_id, []).append((role, person_id))
+            for film_id, country_id in (await session.execute(countries)).all():
+                links.setdefault(film_id, []).append(("country", country_id))
+        ratings = {}
+        for row in film_rows:
+            self.features[row.id] = self._features(row.year, links.get(row.id, []))
+            ratings[row.id] = _parse_rating(row.rating)
+        for row in entry_rows:
+            self.meta[row.id] = {
+                "profile": row.user_id,
+                # Один и тот же фильм в двух коллекциях — один кандидат
+                "film_id": row.film_id,
+                "rating": ratings.get(row.film_id, np.nan),
+                "watched": bool(row.watched),
+                "rating_user": row.rating_user,
+            }
+        self._dirty = True
+
+    async def ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._lock:
+            if not self._loaded:
+                await self._load()
+                self._loaded = True
+
+    async def refresh_films(self, film_ids):
+        if self._loaded and film_ids:
+            async with self._lock:
+                await self._load(film_ids)
+
+    def reset(self):
+        # Записи сменили владельца — проще перечитать всё при следующем запросе
+        self.features.clear()
+        self.meta.clear()
+        self._loaded = False
+        self._dirty = True
+
+    def remove_entry(self, entry_id: int):
+        if self.meta.pop(entry_id, None) is not None:
+            self._dirty = True
+
+    def update_entry(self, entry_id: int, **changes):
+        meta = self.meta.get(entry_id)
+        if meta is None:
+            return
+        meta.update({name: value for name, value in changes.items() if name in ("watched", "rating_user")})
+        row = self._index.get(entry_id)
+        if row is not None and not self._dirty:
+            if "watched" in changes:
+                self._watched[row] = bool(changes["watched"])
+            if "rating_user" in changes:
+                self._user_rating[row] = changes["rating_user"] or np.nan
+
+    def _build(self):
+        if not self._dirty:
+            return
+        self._entry_ids = list(self.meta)
+        self._index = {entry_id: row for row, entry_id in enumerate(self._entry_ids)}
+        metas = [self.meta[entry_id] for entry_id in self._entry_ids]
+        rows = [self.features[meta["film_id"]] for meta in metas]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        for row, (indices, _) in enumerate(rows):
+            indptr[row + 1] = indptr[row] + len(indices)
+        indices = np.concatenate([indices for indices, _ in rows] or [np.empty(0, dtype=np.int32)])
+        values = np.concatenate([values for _, values in rows] or [np.empty(0, dtype=np.float32)])
+        self._matrix = sparse.csr_matrix((values, indices, indptr), shape=(len(rows), len(self.vocab)))
+        self._profiles = {}
+        self._profile = np.array([self._profiles.setdefault(meta["profile"], len(self._profiles)) for meta in metas], dtype=np.int32)
+        self._key = np.array([meta["film_id"] for meta in metas], dtype=np.int64)
+        self._kp_rating = np.nan_to_num(np.array([meta["rating"] for meta in metas], dtype=np.float32)) / 10
+        self._watched = np.array([meta["watched"] for meta in metas], dtype=bool)
+        self._user_rating = np.array([meta["rating_user"] or np.nan for meta in metas], dtype=np.float32)
+        self._dirty = False
+
+    def _taste(self, mask):
+        # Вектор вкуса: оценки 1..10 переводим в веса от -1 до 1
+        weights = np.where(np.isnan(self._user_rating), np.where(self._watched, WATCHED_WEIGHT, 0.0), (self._user_rating - 5.5) / 4.5)
+        weights = np.where(mask, weights, 0.0).astype(np.float32)
+        taste = self._matrix.T @ weights
+        norm = np.linalg.norm(taste)
+        if not norm:
+            return np.zeros(len(self._entry_ids), dtype=np.float32)
+        return self._matrix @ (taste / norm)
+
+    def _top(self, scores, candidates, limit):
+        order = np.argsort(-scores[candidates], kind="stable")
+        result, seen = [], set()
+        for row in candidates[order]:
+            if self._key[row] in seen:
+                continue
+            seen.add(self._key[row])
+            entry_id = self._entry_ids[row]
+            result.append((entry_id, self.meta[entry_id]["profile"], float(scores[row])))
+            if len(result) == limit:
+                break
+        return result
+
+    async def recommend(self, profiles, limit: int = 5, sources=None):
+        # Один профиль — «что посмотреть мне», несколько — «что понравится всем»:
+        # берём минимальную оценку, чтобы фильм подходил каждому
+        await self.ensure_loaded()
+        self._build()
+        if not self._entry_ids:
+            return []
+        codes = [self._profiles.get(profile, -1) for profile in profiles]
+        scores = None
+        seen_keys = []
+        for code in codes:
+            own = self._profile == code
+            taste = self._taste(own)
+            scores = taste if scores is None else np.minimum(scores, taste)
+            seen_keys.append(self._key[own & self._watched])
+        scores = scores + RATING_PRIOR * self._kp_rating
+        candidates = ~np.isin(self._key, np.concatenate(seen_keys))
+        if len(codes) == 1:
+            # Из чужих коллекций предлагаем только то, чего нет в своей
+            own = self._profile == codes[0]
+            candidates &= own | ~np.isin(self._key, self._key[own])
+        if sources is not None:
+            # Кандидаты — только из коллекций, которые пользователю видны
+            candidates &= np.isin(self._profile, [self._profiles.get(profile, -1) for profile in sources])
+        return self._top(scores, np.flatnonzero(candidates), limit)
+
+
+recommender = Recommender()
@@ -0,0 +1,184 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update, or_, func, case
+from models import Film, UserFilm
+from database import SessionLocal
+from kinopoisk import kinopoisk_client
+from cache import response_cache, collection_cache
+from ratelimit import api_budget, QuotaExceeded, BACKGROUND, KINOPOISK_QUOTA_UTC_OFFSET
+from writer import db_writer
+from facets import facet_values, replace_film_facets
+from recommender import recommender
+from services import KINOPOISK_API_BASE, parse_film_details
+
+logger = logging.getLogger(__name__)
+
+REFRESH_ENABLED = os.getenv("REFRESH_ENABLED", "1") == "1"
+# Окно вне пиковой нагрузки, часы по местному времени квоты: "3-7", можно через полночь "23-5"
+REFRESH_WINDOW = os.getenv("REFRESH_WINDOW", "3-7")
+REFRESH_MAX_AGE_DAYS = float(os.getenv("REFRESH_MAX_AGE_DAYS", "14"))
+# Сколько фильмов запрашивать одним GET /movie?id=..&id=..
+REFRESH_BATCH_SIZE = int(os.getenv("REFRESH_BATCH_SIZE", "50"))
+# Сколько запросов к API фоновое обновление может потратить за сутки
+REFRESH_DAILY_REQUESTS = int(os.getenv("REFRESH_DAILY_REQUESTS", "20"))
+REFRESH_PAUSE = float(os.getenv("REFRESH_PAUSE", "5"))
+REFRESH_CHECK_INTERVAL = float(os.getenv("REFRESH_CHECK_INTERVAL", "600"))
+
+KINOPOISK_API_MOVIES = f"{KINOPOISK_API_BASE}movie"
+REFRESH_FIELDS = ("id", "name", "year", "description", "genres", "countries", "persons", "rating", "poster", "videos", "watchability")
+
+
+def parse_window(value: str):
+    start, _, end = value.partition("-")
+    return int(start) % 24, int(end or start) % 24
+
+
+class MetadataRefresher:
+    # Рейтинг и ссылки на просмотр/трейлер со временем меняются, а в каталоге лежат
+    # со дня добавления. Раз в окно без нагрузки перечитываем самые старые фильмы
+    # пачками (один запрос на пачку) с фоновым приоритетом и пишем изменения
+    # одной транзакцией на пачку через общий writer.
+    def __init__(self, enabled=REFRESH_ENABLED, window=REFRESH_WINDOW, max_age_days=REFRESH_MAX_AGE_DAYS,
+                 batch_size=REFRESH_BATCH_SIZE, daily_requests=REFRESH_DAILY_REQUESTS, pause=REFRESH_PAUSE, check_interval=REFRESH_CHECK_INTERVAL,
+                 utc_offset=KINOPOISK_QUOTA_UTC_OFFSET):
+        self.enabled = enabled
+        self.window = parse_window(window)
+        self.max_age = max_age_days * 86400
+        self.batch_size = batch_size
+        self.daily_requests = daily_requests
+        self.pause = pause
+        self.check_interval = check_interval
+        self.tz = timezone(timedelta(hours=utc_offset))
+        self.day = None
+        self.used = 0
+        self.refreshed = 0
+        self._task = None
+
+    def in_window(self, now=None):
+        hour = (now or datetime.now(self.tz)).hour
+        start, end = self.window
+        if start == end:
+            return True
+        return start <= hour < end if start < end else hour >= start or hour < end
+
+    def budget_left(self):
+        day = datetime.now(self.tz).date().isoformat()
+        if day != self.day:
+            self.day, self.used = day, 0
+        return self.daily_requests - self.used
+
+    async def stale_ids(self, limit: int):
+        cutoff = time.time() - self.max_age
+        # Каталог общий, так что каждый фильм запрашивается один раз, сколько бы коллекций
+        # его ни содержали. Начинаем с никогда не обновлявшихся, фильмы без коллекций пропускаем
+        query = (
+            select(Film.kinopoisk_id)
+            .where(
+                Film.kinopoisk_id.is_not(None),
+                or_(Film.refreshed_at.is_(None), Film.refreshed_at < cutoff),
+                Film.id.in_(select(UserFilm.film_id)),
+            )
+            .order_by(func.coalesce(Film.refreshed_at, 0))
+            .limit(limit)
+        )
+        async with SessionLocal() as session:
+            return list((await session.scalars(query)).all())
+
+    async def fetch(self, kinopoisk_ids):
+        params = [("id", kinopoisk_id) for kinopoisk_id in kinopoisk_ids]
+        params += [("selectFields", field) for field in REFRESH_FIELDS]
+        params.append(("limit", len(kinopoisk_ids)))
+        self.used += 1
+        data = await kinopoisk_client.get_json(KINOPOISK_API_MOVIES, params=params, priority=BACKGROUND)
+        if data is None:
+            return None
+        return {film["id"]: parse_film_details(film) for film in data.get("docs", []) if film.get("id")}
+
+    async def apply(self, kinopoisk_ids, details):
+        now = time.time()
+        statements = []
+        for kinopoisk_id in kinopoisk_ids:
+            film = details.get(kinopoisk_id)
+            values = {"refreshed_at": now}
+            if film is not None:
+                # Пустые поля из ответа не затирают то, что уже сохранено
+                for column in ("rating", "trailer_url", "watch_url", "description", "director", "actors", "genre", "country"):
+                    if film.get(column):
+                        values[column] = film[column]
+                if film.get("poster_url"):
+                    values["poster_url"] = film["poster_url"]
+                    # Сменился постер — загруженный в Telegram file_id больше не подходит
+                    values["poster_file_id"] = case((Film.poster_url == film["poster_url"], Film.poster_file_id), else_=None)
+            stmt = update(Film).where(Film.kinopoisk_id == kinopoisk_id).values(**values).returning(Film.id)
+            statements.append((stmt, facet_values(film) if film is not None else None))
+
+        async def store(session):
+            film_ids = []
+            for stmt, facets in statements:
+                film_id = (await session.execute(stmt)).scalar()
+                if film_id is None:
+                    continue
+                if facets is not None and any(facets.values()):
+                    await replace_film_facets(session, film_id, facets)
+                film_ids.append(film_id)
+            profiles = (await session.scalars(select(UserFilm.user_id).where(UserFilm.film_id.in_(film_ids)).distinct())).all()
+            return film_ids, profiles
+
+        film_ids, profiles = await db_writer.submit(store)
+        for film in details.values():
+            await response_cache.set("movie", str(film["kinopoiskId"]), film)
+        for profile in profiles:
+            collection_cache.invalidate(profile)
+        await recommender.refresh_films(film_ids)
+        return len(film_ids)
+
+    async def run_once(self):
+        # Возвращает число обновлённых фильмов каталога; 0 — обновлять нечего или нельзя
+        total = 0
+        while self.in_window() and self.budget_left() > 0:
+            if await api_budget.nearly_exhausted():
+                logger.info("metadata refresh paused: kinopoisk quota is low")
+                break
+            kinopoisk_ids = await self.stale_ids(self.batch_size)
+            if not kinopoisk_ids:
+                break
+            try:
+                details = await self.fetch(kinopoisk_ids)
+            except QuotaExceeded:
+                logger.info("metadata refresh paused: background quota exhausted")
+                break
+            if details is None:
+                break
+            total += await self.apply(kinopoisk_ids, details)
+            await asyncio.sleep(self.pause)
+        if total:
+            self.refreshed += total
+            logger.info("metadata refreshed films=%s requests_today=%s", total, self.used)
+        return total
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("metadata refresh failed")
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+metadata_refresher = MetadataRefresher()
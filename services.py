@@ -1,121 +1,575 @@
 import os
+import re
+import time
 import random
-import aiohttp
+import secrets
 import asyncio
-from models import Film
+import logging
+from models import Film, UserFilm, Profile, CollectionShare, COLLECTION_COLUMNS
 from database import SessionLocal
-from sqlalchemy import select
+from sqlalchemy import select, func, update, delete, text
+from sqlalchemy.dialects.sqlite import insert
+from kinopoisk import kinopoisk_client
+from cache import response_cache, collection_cache, normalize_query, fold_yo, SingleFlight, FilmSnapshot
+from ratelimit import api_budget, QuotaExceeded, INTERACTIVE, BACKGROUND
+from writer import db_writer
+from facets import facet_values, replace_film_facets, filter_conditions, facet_options_query
+from recommender import recommender
 
-KINOPOISK_API_TOKEN = os.getenv("KINOPOISK_API_TOKEN") or "ACTXDM9-R3M4XBF-NDSC4BB-BPMF9BN"
-KINOPOISK_API_URL = "https://api.kinopoisk.dev/v1.4/movie/search"
-KINOPOISK_API_MOVIE = "https://api.kinopoisk.dev/v1.4/movie/"
+logger = logging.getLogger(__name__)
 
-async def search_films_kinopoisk(title: str, limit: int = 5):
-    headers = {"X-API-KEY": KINOPOISK_API_TOKEN}
+KINOPOISK_API_BASE = os.getenv("KINOPOISK_API_BASE", "https://api.kinopoisk.dev/v1.4/")
+KINOPOISK_API_URL = f"{KINOPOISK_API_BASE}movie/search"
+KINOPOISK_API_MOVIE = f"{KINOPOISK_API_BASE}movie/"
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "5"))
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10"))
+SEARCH_RESULTS_LIMIT = int(os.getenv("SEARCH_RESULTS_LIMIT", "10"))
+FACET_OPTIONS_LIMIT = int(os.getenv("FACET_OPTIONS_LIMIT", "20"))
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "5"))
+RECOMMENDATIONS_LIMIT = int(os.getenv("RECOMMENDATIONS_LIMIT", "5"))
+# Кому достаются старые именные коллекции: "Имя:telegram_id" через запятую.
+# Без записи здесь коллекцию не может занять никто
+LEGACY_PROFILES = {
+    name.strip(): int(user_id)
+    for name, _, user_id in (item.rpartition(":") for item in os.getenv("LEGACY_PROFILES", "").split(",") if item.strip())
+}
+
+FTS_COLUMNS = ", ".join(f"{column.table.name}.{column.name}" for column in COLLECTION_COLUMNS)
+
+inflight = SingleFlight()
+_background_tasks = set()
+_profiles = None
+
+async def _cached_call(kind: str, key: str, fetch, *args, priority=INTERACTIVE):
+    cached = await response_cache.get(kind, key)
+    if cached is not None:
+        return cached
+    # Квота почти кончилась: лучше показать устаревшие данные, чем тратить запрос
+    if await api_budget.nearly_exhausted():
+        stale = await response_cache.get(kind, key, allow_stale=True)
+        if stale is not None:
+            return stale
+    try:
+        return await inflight.do((kind, key), fetch, *args, priority=priority)
+    except QuotaExceeded:
+        stale = await response_cache.get(kind, key, allow_stale=True)
+        if stale is not None:
+            return stale
+        if priority != INTERACTIVE:
+            raise
+        # Мог присоединиться к фоновому запросу, которому не хватило резерва
+        return await fetch(*args, INTERACTIVE)
+
+async def search_films_kinopoisk(title: str, limit: int = 5, priority=INTERACTIVE):
+    cache_key = f"{limit}:{normalize_query(title)}"
+    return await _cached_call("search", cache_key, _fetch_search, title, limit, cache_key, priority=priority)
+
+async def _fetch_search(title: str, limit: int, cache_key: str, priority=INTERACTIVE):
     params = {"query": title, "limit": limit}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(KINOPOISK_API_URL, headers=headers, params=params) as resp:
-            data = await resp.json()
-            films = data.get("docs", [])
-            result = []
-            for film in films:
-                result.append({
-                    "kinopoiskId": film.get("id"),
-                    "title": film.get("name"),
-                    "year": film.get("year"),
-                    "genre": film.get("genres", [{}])[0].get("name"),
-                    "description": film.get("description"),
-                    "trailer_url": film.get("videos", {}).get("trailers", [{}])[0].get("url"),
-                    "poster_url": film.get("poster", {}).get("url"),
-                    "watch_url": film.get("watchability", {}).get("items", [{}])[0].get("url")
-                })
-            return result
+    data = await kinopoisk_client.get_json(KINOPOISK_API_URL, params=params, priority=priority)
+    if not data:
+        return []
+    films = data.get("docs", [])
+    result = []
+    for film in films:
+        result.append({
+            "kinopoiskId": film.get("id"),
+            "title": film.get("name"),
+            "year": film.get("year"),
+            "genre": film.get("genres", [{}])[0].get("name"),
+            "description": film.get("description"),
+            "trailer_url": film.get("videos", {}).get("trailers", [{}])[0].get("url"),
+            "poster_url": film.get("poster", {}).get("url"),
+            "watch_url": film.get("watchability", {}).get("items", [{}])[0].get("url"),
+            # Этого хватает, чтобы импорт обходился без запроса деталей на каждый фильм
+            "rating": film.get("rating", {}).get("kp"),
+            "genres": [g.get("name") for g in film.get("genres", []) if g.get("name")],
+            "countries": [c.get("name") for c in film.get("countries", []) if c.get("name")],
+        })
+    await response_cache.set("search", cache_key, result)
+    return result
 
 def safe_first(lst, key=None):
     if lst and len(lst) > 0:
         return lst[0].get(key) if key and isinstance(lst[0], dict) else lst[0]
     return None
 
-async def get_film_details_kinopoisk(film_id: str):
-    headers = {"X-API-KEY": KINOPOISK_API_TOKEN}
+async def get_film_details_kinopoisk(film_id: str, priority=INTERACTIVE):
+    return await _cached_call("movie", str(film_id), _fetch_film_details, str(film_id), priority=priority)
+
+def parse_film_details(film: dict):
+    genres = [g.get("name") for g in film.get("genres", []) if g.get("name")]
+    directors = [p.get("name") for p in film.get("persons", []) if p.get("profession") == "режиссеры" and p.get("name")]
+    cast = [p.get("name") for p in film.get("persons", []) if p.get("profession") == "актеры" and p.get("name")][:5]
+    countries = [c.get("name") for c in film.get("countries", []) if c.get("name")]
+    return {
+        "kinopoiskId": film.get("id"),
+        "title": film.get("name"),
+        "year": film.get("year"),
+        "genre": ", ".join(genres),
+        "description": film.get("description"),
+        "trailer_url": safe_first(film.get("videos", {}).get("trailers", []), "url"),
+        "poster_url": film.get("poster", {}).get("url"),
+        "watch_url": safe_first(film.get("watchability", {}).get("items", []), "url"),
+        "director": ", ".join(directors),
+        "actors": ", ".join(cast),
+        "country": ", ".join(countries),
+        "rating": film.get("rating", {}).get("kp"),
+        "watched": False,
+        # Те же значения списками — для таблиц жанров, персон и стран
+        "genres": genres,
+        "directors": directors,
+        "cast": cast,
+        "countries": countries,
+    }
+
+async def _fetch_film_details(film_id: str, priority=INTERACTIVE):
     try:
-        print(f"[DEBUG] Запрос деталей фильма: {film_id}")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{KINOPOISK_API_MOVIE}{film_id}", headers=headers, timeout=10) as resp:
-                print(f"[DEBUG] Статус ответа: {resp.status}")
-                if resp.status != 200:
-                    print(f"Kinopoisk API error: status {resp.status}")
-                    print(f"[DEBUG] Текст ответа: {await resp.text()}")
-                    return None
-                film = await resp.json()
-                print(f"[DEBUG] Ответ JSON: {film}")
-                return {
-                    "kinopoiskId": film.get("id"),
-                    "title": film.get("name"),
-                    "year": film.get("year"),
-                    "genre": ", ".join([g.get("name") for g in film.get("genres", [])]),
-                    "description": film.get("description"),
-                    "trailer_url": safe_first(film.get("videos", {}).get("trailers", []), "url"),
-                    "poster_url": film.get("poster", {}).get("url"),
-                    "watch_url": safe_first(film.get("watchability", {}).get("items", []), "url"),
-                    "director": ", ".join([p.get("name") for p in film.get("persons", []) if p.get("profession") == "режиссеры"]),
-                    "actors": ", ".join([p.get("name") for p in film.get("persons", []) if p.get("profession") == "актеры"][:5]),
-                    "country": ", ".join([c.get("name") for c in film.get("countries", [])]),
-                    "rating": film.get("rating", {}).get("kp"),
-                    "watched": False
-                }
-    except asyncio.TimeoutError:
-        print("Timeout while fetching film details")
-        return None
-    except Exception as e:
-        print(f"Error fetching film details: {e}")
+        film = await kinopoisk_client.get_json(f"{KINOPOISK_API_MOVIE}{film_id}", priority=priority)
+        if film is None:
+            return None
+        logger.debug("kinopoisk movie fetched id=%s name=%r", film_id, film.get("name"))
+        details = parse_film_details(film)
+    except QuotaExceeded:
+        raise
+    except Exception:
+        logger.exception("film details parse failed id=%s", film_id)
         return None
+    await response_cache.set("movie", str(film_id), details)
+    return details
+
+async def prefetch_film_details(film_ids):
+    # Префетч — самое необязательное из фонового: если квоты над резервом не хватит на всю пачку,
+    # лучше оставить её импорту и обновлению метаданных
+    if await api_budget.background_headroom() < len(film_ids):
+        logger.info("prefetch skipped: quota is close to the reserve films=%d", len(film_ids))
+        return
+    semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+    async def fetch(film_id):
+        async with semaphore:
+            await get_film_details_kinopoisk(str(film_id), priority=BACKGROUND)
+
+    await asyncio.gather(*(fetch(film_id) for film_id in film_ids if film_id), return_exceptions=True)
+
+def schedule_background(coro):
+    # Держим ссылку на задачу, иначе её может собрать сборщик мусора,
+    # а при остановке бота drain_background_tasks её дождётся
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def schedule_prefetch(film_ids):
+    return schedule_background(prefetch_film_details(list(film_ids)))
+
+async def drain_background_tasks(timeout: float):
+    # Начатые префетчи и импорты доделываются; не успевшие за timeout отменяются
+    if not _background_tasks:
+        return
+    _, pending = await asyncio.wait(set(_background_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+async def add_film_from_kinopoisk(film_data: dict, profile: int):
+    values = dict(
+        title=film_data["title"],
+        year=film_data.get("year"),
+        genre=film_data.get("genre"),
+        description=film_data.get("description"),
+        trailer_url=film_data.get("trailer_url"),
+        poster_url=film_data.get("poster_url"),
+        watch_url=film_data.get("watch_url"),
+        director=film_data.get("director"),
+        actors=film_data.get("actors"),
+        country=film_data.get("country"),
+        rating=film_data.get("rating"),
+        refreshed_at=time.time(),
+    )
+    # Фильм уже в каталоге (его добавлял кто-то ещё) — только обновляем метаданные
+    catalog = insert(Film).values(
+        **values,
+        kinopoisk_id=film_data.get("kinopoiskId"),
+        poster_file_id=film_data.get("poster_file_id"),
+    ).on_conflict_do_update(index_elements=[Film.kinopoisk_id], set_=values).returning(Film.id)
+    facets = facet_values(film_data)
+
+    async def upsert(session):
+        film_id = (await session.execute(catalog)).scalar_one()
+        await replace_film_facets(session, film_id, facets)
+        # Повторное добавление в свою коллекцию не сбрасывает отметку о просмотре, оценку и комментарий
+        entry = insert(UserFilm).values(
+            user_id=profile, film_id=film_id, watched=film_data.get("watched", False),
+        ).on_conflict_do_update(index_elements=[UserFilm.user_id, UserFilm.film_id], set_={"film_id": film_id}).returning(UserFilm.id)
+        return film_id, (await session.execute(entry)).scalar_one()
+
+    film_id, entry_id = await db_writer.submit(upsert)
+    collection_cache.invalidate(profile)
+    collection_cache.update_catalog_film(film_id, **values)
+    await recommender.refresh_films([film_id])
+    return entry_id
+
+def _pick_match(films, year):
+    if year:
+        for film in films:
+            if film.get("year") == year:
+                return film
+    return films[0] if films else None
+
+async def resolve_import(items, progress=None, concurrency: int = IMPORT_CONCURRENCY):
+    # Названия ищутся параллельно, но не больше concurrency запросов сразу
+    # и с фоновым приоритетом: интерактивные запросы других пользователей идут первыми.
+    # Возвращает найденные фильмы, не найденные названия и число необработанных
+    # (если кончилась доступная фоновым задачам квота).
+    queue = asyncio.Queue()
+    for index, item in enumerate(items):
+        queue.put_nowait((index, item))
+    resolved = [None] * len(items)
+    missing = []
+    done = 0
+    quota_exceeded = False
+
+    async def worker():
+        nonlocal done, quota_exceeded
+        while not quota_exceeded and not queue.empty():
+            index, item = queue.get_nowait()
+            try:
+                match = _pick_match(await search_films_kinopoisk(item["title"], priority=BACKGROUND), item.get("year"))
+            except QuotaExceeded:
+                quota_exceeded = True
+                queue.put_nowait((index, item))
+                return
+            if match and match.get("kinopoiskId"):
+                resolved[index] = {**match, "watched": item.get("watched", False), "rating_user": item.get("rating_user")}
+            else:
+                missing.append(item["title"])
+            done += 1
+            if progress is not None:
+                await progress(done, len(items))
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(items)))))
+    return [film for film in resolved if film], missing, queue.qsize()
+
+async def add_films_bulk(films, profile: int):
+    # Вся пачка — одна транзакция writer'а: недостающие фильмы одним INSERT в каталог,
+    # затем записи коллекции. То, что уже есть в коллекции, не трогаем
+    catalog, facets, entries = {}, {}, {}
+    for film in films:
+        if film["kinopoiskId"] in catalog:
+            continue
+        catalog[film["kinopoiskId"]] = dict(
+            title=film["title"],
+            year=film.get("year"),
+            genre=", ".join(film.get("genres") or []) or film.get("genre"),
+            description=film.get("description"),
+            trailer_url=film.get("trailer_url"),
+            poster_url=film.get("poster_url"),
+            watch_url=film.get("watch_url"),
+            country=", ".join(film.get("countries") or []) or None,
+            rating=film.get("rating"),
+            kinopoisk_id=film["kinopoiskId"],
+        )
+        facets[film["kinopoiskId"]] = facet_values(film)
+        entries[film["kinopoiskId"]] = dict(watched=bool(film.get("watched")), rating_user=film.get("rating_user"))
+    if not catalog:
+        return []
+    new_films = insert(Film).on_conflict_do_nothing(index_elements=[Film.kinopoisk_id]).returning(Film.id, Film.kinopoisk_id)
+    film_ids = select(Film.kinopoisk_id, Film.id).where(Film.kinopoisk_id.in_(list(catalog)))
+    new_entries = insert(UserFilm).on_conflict_do_nothing(index_elements=[UserFilm.user_id, UserFilm.film_id]).returning(UserFilm.id, UserFilm.film_id)
+
+    async def insert_all(session):
+        for film_id, kinopoisk_id in (await session.execute(new_films, list(catalog.values()))).all():
+            await replace_film_facets(session, film_id, facets[kinopoisk_id])
+        ids = dict((await session.execute(film_ids)).all())
+        rows = [{"user_id": profile, "film_id": ids[kinopoisk_id], **entry} for kinopoisk_id, entry in entries.items()]
+        return (await session.execute(new_entries, rows)).all()
+
+    added = await db_writer.submit(insert_all)
+    collection_cache.invalidate(profile)
+    await recommender.refresh_films([film_id for _, film_id in added])
+    return [entry_id for entry_id, _ in added]
+
+def _snapshots(result):
+    return [FilmSnapshot(**row._mapping) for row in result]
+
+def _collection_query(*conditions):
+    return select(*COLLECTION_COLUMNS).join_from(UserFilm, Film, UserFilm.film_id == Film.id).where(*conditions)
+
+async def _load_collection(profile: int, max_films: int):
+    async with SessionLocal() as session:
+        count = await session.scalar(select(func.count()).select_from(UserFilm).where(UserFilm.user_id == profile))
+        # Слишком большие коллекции не кэшируем, их читаем из базы постранично
+        if count > max_films:
+            return None
+        result = await session.execute(_collection_query(UserFilm.user_id == profile).order_by(UserFilm.id))
+        return _snapshots(result)
+
+async def _collection(profile: int):
+    return await collection_cache.get(profile, _load_collection)
+
+async def _update_film(film_id: int, profile: int, **changes):
+    stmt = update(UserFilm).where(UserFilm.id == film_id, UserFilm.user_id == profile).values(**changes)
+    result = await db_writer.submit(lambda session: session.execute(stmt))
+    if not result.rowcount:
+        return False
+    collection_cache.update_film(profile, film_id, **changes)
+    recommender.update_entry(film_id, **changes)
+    return True
+
+async def get_film(film_id: int, profile: int):
+    # Выборка по первичному ключу с проверкой, что запись принадлежит профилю
+    collection = await _collection(profile)
+    if collection is not None:
+        return collection.by_id.get(film_id)
+    return await get_film_entry(film_id, profile)
+
+async def get_film_entry(film_id: int, profile: int = None):
+    # Без profile — для просмотра чужих коллекций и рекомендаций из них
+    conditions = [UserFilm.id == film_id] if profile is None else [UserFilm.id == film_id, UserFilm.user_id == profile]
+    async with SessionLocal() as session:
+        films = _snapshots(await session.execute(_collection_query(*conditions)))
+        return films[0] if films else None
+
+async def mark_film_watched(film_id: int, profile: int):
+    return await _update_film(film_id, profile, watched=True)
+
+async def set_film_rating(film_id: int, profile: int, rating: int):
+    return await _update_film(film_id, profile, rating_user=rating)
 
-async def add_film_from_kinopoisk(film_data: dict, profile: str):
+async def set_film_comment(film_id: int, profile: int, comment: str):
+    return await _update_film(film_id, profile, comment_user=comment)
+
+async def get_poster_file_id(kinopoisk_id: int):
+    async with SessionLocal() as session:
+        return await session.scalar(select(Film.poster_file_id).where(Film.kinopoisk_id == kinopoisk_id))
+
+async def set_poster_file_id(file_id: str, kinopoisk_id: int = None, film_id: int = None):
+    # film_id — id в каталоге; постер один на фильм, поэтому годится для всех коллекций
+    condition = Film.kinopoisk_id == kinopoisk_id if kinopoisk_id else Film.id == film_id
+    stmt = update(Film).where(condition).values(poster_file_id=file_id).returning(Film.id)
+
+    async def store(session):
+        return (await session.execute(stmt)).scalars().all()
+
+    for catalog_id in await db_writer.submit(store):
+        collection_cache.update_catalog_film(catalog_id, poster_file_id=file_id)
+
+async def delete_film(film_id: int, profile: int):
+    # Из каталога фильм не удаляется: его метаданные пригодятся при следующем добавлении
+    stmt = delete(UserFilm).where(UserFilm.id == film_id, UserFilm.user_id == profile)
+    result = await db_writer.submit(lambda session: session.execute(stmt))
+    if not result.rowcount:
+        return False
+    collection_cache.remove_film(profile, film_id)
+    recommender.remove_entry(film_id)
+    return True
+
+async def get_watched_films(profile: int):
+    collection = await _collection(profile)
+    if collection is not None:
+        return collection.filter(watched=True)
+    async with SessionLocal() as session:
+        result = await session.execute(_collection_query(UserFilm.watched == True, UserFilm.user_id == profile))
+        return _snapshots(result)
+
+async def get_films_page(profile: int, after_id: int = None, before_id: int = None, watched: bool = None, limit: int = PAGE_SIZE):
+    collection = await _collection(profile)
+    if collection is not None:
+        return collection.page(after_id=after_id, before_id=before_id, watched=watched, limit=limit)
+    query = _collection_query(UserFilm.user_id == profile)
+    if watched is not None:
+        query = query.where(UserFilm.watched == watched)
+    return await _keyset_page(query, after_id, before_id, limit)
+
+async def filter_films_page(profile: int, filters: dict, after_id: int = None, before_id: int = None, limit: int = PAGE_SIZE):
+    # Фильтры по жанру/персоне/стране идут через индексы таблиц связей
+    query = _collection_query(UserFilm.user_id == profile, *filter_conditions(filters))
+    return await _keyset_page(query, after_id, before_id, limit)
+
+async def get_facet_options(profile: int, facet: str, limit: int = FACET_OPTIONS_LIMIT):
+    async with SessionLocal() as session:
+        result = await session.execute(facet_options_query(facet, profile, limit))
+        return result.all()
+
+async def _keyset_page(query, after_id: int = None, before_id: int = None, limit: int = PAGE_SIZE):
+    # Keyset-пагинация по id: читаем только одну страницу плюс одну запись,
+    # чтобы узнать, есть ли следующая
+    if before_id is not None:
+        query = query.where(UserFilm.id < before_id).order_by(UserFilm.id.desc())
+    else:
+        if after_id is not None:
+            query = query.where(UserFilm.id > after_id)
+        query = query.order_by(UserFilm.id)
+    async with SessionLocal() as session:
+        result = await session.execute(query.limit(limit + 1))
+        films = _snapshots(result)
+    has_more = len(films) > limit
+    films = films[:limit]
+    if before_id is not None:
+        films.reverse()
+        return films, has_more, True
+    return films, after_id is not None, has_more
+
+async def iter_films(profile: int, watched: bool = None, batch_size: int = 100):
+    # Отдаёт коллекцию порциями, не держа её целиком в памяти и не держа открытую транзакцию
+    after_id = None
+    while True:
+        films, _, has_next = await get_films_page(profile, after_id=after_id, watched=watched, limit=batch_size)
+        for film in films:
+            yield film
+        if not has_next:
+            return
+        after_id = films[-1].id
+
+async def get_random_film(profile: int):
+    collection = await _collection(profile)
+    if collection is not None:
+        return random.choice(collection.films) if collection.films else None
+    # Случайный фильм выбирается в SQL: count + offset по индексу (user_id, id)
+    async with SessionLocal() as session:
+        count = await session.scalar(select(func.count()).select_from(UserFilm).where(UserFilm.user_id == profile))
+        if not count:
+            return None
+        result = await session.execute(
+            _collection_query(UserFilm.user_id == profile).order_by(UserFilm.id).offset(random.randrange(count)).limit(1)
+        )
+        films = _snapshots(result)
+        return films[0] if films else None
+
+async def get_all_films(profile: int):
+    collection = await _collection(profile)
+    if collection is not None:
+        return collection.films
     async with SessionLocal() as session:
-        session.add(Film(
-            title=film_data["title"],
-            year=film_data.get("year"),
-            genre=film_data.get("genre"),
-            description=film_data.get("description"),
-            trailer_url=film_data.get("trailer_url"),
-            poster_url=film_data.get("poster_url"),
-            watch_url=film_data.get("watch_url"),
-            director=film_data.get("director"),
-            actors=film_data.get("actors"),
-            country=film_data.get("country"),
-            rating=film_data.get("rating"),
-            watched=film_data.get("watched", False),
-            profile=profile
-        ))
-        await session.commit()
-
-async def mark_film_watched(film_id: int):
+        result = await session.execute(_collection_query(UserFilm.user_id == profile))
+        return _snapshots(result)
+
+async def get_recommendations(profiles, sources, limit: int = RECOMMENDATIONS_LIMIT):
+    # Фильм может лежать в чужой коллекции, поэтому отдаём его вместе с профилем-владельцем.
+    # sources — коллекции, которые пользователю видны: свои и открытые ему
+    recommended = await recommender.recommend(profiles, limit=limit, sources=sources)
+    films = [(await get_film(entry_id, owner), owner) for entry_id, owner, _ in recommended]
+    return [(film, owner) for film, owner in films if film is not None]
+
+def _fts_query(query: str):
+    # Каждое слово ищется по префиксу: "крест отец" найдёт "Крёстный отец"
+    return " ".join(f'"{token}"*' for token in re.findall(r"\w+", fold_yo(query.lower())))
+
+async def search_my_films(profile: int, query: str, limit: int = SEARCH_RESULTS_LIMIT):
+    match = _fts_query(query)
+    if not match:
+        return []
+    # bm25: совпадение в названии весит больше, чем в описании
+    stmt = text(
+        f"SELECT {FTS_COLUMNS} FROM films_fts JOIN films ON films.id = films_fts.rowid "
+        "JOIN user_films ON user_films.film_id = films.id "
+        "WHERE films_fts MATCH :match AND user_films.user_id = :profile "
+        "ORDER BY bm25(films_fts, 10.0, 1.0, 3.0, 2.0, 2.0) LIMIT :limit"
+    ).columns(*COLLECTION_COLUMNS)
     async with SessionLocal() as session:
-        film = await session.get(Film, film_id)
-        if film:
-            film.watched = True
-            await session.commit()
+        result = await session.execute(stmt, {"match": match, "profile": profile, "limit": limit})
+        return _snapshots(result)
+
+async def _profile_names():
+    # Таблица профилей крошечная и меняется только функциями ниже — держим её в памяти
+    global _profiles
+    if _profiles is None:
+        async with SessionLocal() as session:
+            _profiles = dict((await session.execute(select(Profile.user_id, Profile.name))).all())
+    return _profiles
+
+async def get_profile_name(user_id: int):
+    return (await _profile_names()).get(user_id)
+
+async def get_unclaimed_profiles(user_id: int):
+    # Именные профили из времён, когда коллекций было две и выбирались они по имени,
+    # которые LEGACY_PROFILES отдаёт этому пользователю
+    return sorted(name for owner, name in (await _profile_names()).items() if owner < 0 and LEGACY_PROFILES.get(name) == user_id)
+
+async def create_profile(user_id: int, name: str):
+    profiles = await _profile_names()
+    if user_id not in profiles:
+        # Профиль виден сразу из памяти, запись в базу уходит попутной транзакцией writer'а
+        profiles[user_id] = name
+        stmt = insert(Profile).values(user_id=user_id, name=name).on_conflict_do_nothing()
+        db_writer.submit_nowait(lambda session: session.execute(stmt))
+    return profiles[user_id]
+
+async def claim_profile(name: str, user_id: int):
+    # Старая именная коллекция переходит к пользователю, который её выбрал.
+    # None — если её уже занял кто-то другой или она предназначена не ему
+    if LEGACY_PROFILES.get(name) != user_id:
+        return None
+    profiles = await _profile_names()
 
-async def delete_film(film_id: int):
+    async def claim(session):
+        if await session.get(Profile, user_id) is not None:
+            return None
+        legacy_id = await session.scalar(select(Profile.user_id).where(Profile.name == name, Profile.user_id < 0).limit(1))
+        if legacy_id is None:
+            return None
+        await session.execute(update(UserFilm).where(UserFilm.user_id == legacy_id).values(user_id=user_id))
+        await session.execute(update(Profile).where(Profile.user_id == legacy_id).values(user_id=user_id))
+        await session.execute(update(CollectionShare).where(CollectionShare.owner_id == legacy_id).values(owner_id=user_id))
+        await session.execute(update(CollectionShare).where(CollectionShare.viewer_id == legacy_id).values(viewer_id=user_id))
+        return legacy_id
+
+    legacy_id = await db_writer.submit(claim)
+    if legacy_id is None:
+        return None
+    profiles.pop(legacy_id, None)
+    profiles[user_id] = name
+    collection_cache.invalidate(legacy_id)
+    collection_cache.invalidate(user_id)
+    recommender.reset()
+    return name
+
+async def get_shared_profiles(viewer: int):
+    # Коллекции, которые владельцы открыли этому пользователю, по имени
     async with SessionLocal() as session:
-        film = await session.get(Film, film_id)
-        if film:
-            await session.delete(film)
-            await session.commit()
+        owners = (await session.scalars(select(CollectionShare.owner_id).where(CollectionShare.viewer_id == viewer))).all()
+    names = await _profile_names()
+    return dict(sorted(((owner, names[owner]) for owner in owners if owner in names), key=lambda item: item[1]))
 
-async def get_watched_films(profile: str):
+async def get_viewers(owner: int):
     async with SessionLocal() as session:
-        result = await session.execute(select(Film).where(Film.watched == True, Film.profile == profile))
-        return result.scalars().all()
+        viewers = (await session.scalars(select(CollectionShare.viewer_id).where(CollectionShare.owner_id == owner))).all()
+    names = await _profile_names()
+    return dict(sorted(((viewer, names[viewer]) for viewer in viewers if viewer in names), key=lambda item: item[1]))
 
-async def get_random_film(profile: str):
+async def can_view(viewer: int, owner: int):
+    if viewer == owner:
+        return True
     async with SessionLocal() as session:
-        result = await session.execute(select(Film).where(Film.profile == profile))
-        films = result.scalars().all()
-        return random.choice(films) if films else None
+        return await session.get(CollectionShare, (owner, viewer)) is not None
+
+async def get_share_code(owner: int, renew: bool = False):
+    # renew — новая ссылка: старая перестаёт работать, уже выданный доступ остаётся
+    if not renew:
+        async with SessionLocal() as session:
+            code = await session.scalar(select(Profile.share_code).where(Profile.user_id == owner))
+        if code:
+            return code
+    code = secrets.token_urlsafe(12)
+
+    async def store(session):
+        await session.execute(update(Profile).where(Profile.user_id == owner).values(share_code=code))
+        return code
 
-async def get_all_films(profile: str):
+    return await db_writer.submit(store)
+
+async def accept_share(code: str, viewer: int):
+    # Возвращает владельца коллекции; None — ссылка устарела или своя собственная
     async with SessionLocal() as session:
-        result = await session.execute(select(Film).where(Film.profile == profile))
-        return result.scalars().all() 
\ No newline at end of file
+        owner = await session.scalar(select(Profile.user_id).where(Profile.share_code == code))
+    if owner is None or owner == viewer:
+        return None
+    stmt = insert(CollectionShare).values(owner_id=owner, viewer_id=viewer).on_conflict_do_nothing()
+    await db_writer.submit(lambda session: session.execute(stmt))
+    return owner
+
+async def revoke_share(owner: int, viewer: int):
+    stmt = delete(CollectionShare).where(CollectionShare.owner_id == owner, CollectionShare.viewer_id == viewer)
+    await db_writer.submit(lambda session: session.execute(stmt))
+
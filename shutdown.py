@@ -0,0 +1,69 @@
+import time
+import asyncio
+import logging
+from aiogram import BaseMiddleware
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal
+from models import PollingState
+from writer import db_writer
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateTracker(BaseMiddleware):
+    # Внешний middleware на dp.update: знает, какие апдейты ещё в работе,
+    # чтобы при остановке дождаться их и сохранить offset для следующего запуска
+    def __init__(self):
+        self.running = set()
+        self.last_update_id = None
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        update_id = event.update_id
+        self.running.add(update_id)
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.running.discard(update_id)
+            if self.last_update_id is None or update_id > self.last_update_id:
+                self.last_update_id = update_id
+            if not self.running:
+                self._idle.set()
+
+    async def drain(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("shutdown timeout: %d updates still running", len(self.running))
+            return False
+        return True
+
+    def offset(self):
+        # Всё, что меньше offset, Telegram считает доставленным. Недоделанный за таймаут
+        # апдейт лучше получить ещё раз, чем потерять, поэтому offset не выше первого из них
+        if self.running:
+            return min(self.running)
+        return self.last_update_id + 1 if self.last_update_id is not None else None
+
+
+async def load_offset(bot_id: int):
+    async with SessionLocal() as session:
+        row = await session.get(PollingState, bot_id)
+    return row.offset if row else None
+
+
+async def save_offset(bot_id: int, offset: int):
+    stmt = insert(PollingState).values(bot_id=bot_id, offset=offset, updated_at=time.time())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[PollingState.bot_id],
+        set_={"offset": stmt.excluded.offset, "updated_at": stmt.excluded.updated_at},
+    )
+    await db_writer.submit(lambda session: session.execute(stmt))
+
+
+async def confirm_offset(bot, offset: int):
+    # getUpdates с offset подтверждает всё, что раньше; limit=1 и timeout=0 — чтобы не ждать
+    # и ничего лишнего не забрать: вернувшийся апдейт не подтверждён и придёт в polling
+    await bot.get_updates(offset=offset, limit=1, timeout=0)
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal
+from writer import db_writer
+from models import FsmState
+
+logger = logging.getLogger(__name__)
+
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+FSM_FLUSH_BATCH = int(os.getenv("FSM_FLUSH_BATCH", "100"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+
+
+class SQLiteStorage(BaseStorage):
+    # Хранилище FSM в таблице fsm_states. Бот — единственный, кто её пишет,
+    # поэтому загруженная запись в памяти считается актуальной: повторные
+    # get_state/get_data внутри апдейта (ensure_profile + сам хендлер) и между
+    # апдейтами не ходят в базу. Изменения копятся и пишутся пачкой (write-behind).
+    def __init__(self, flush_interval=FSM_FLUSH_INTERVAL, flush_batch=FSM_FLUSH_BATCH, cache_size=FSM_CACHE_SIZE):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.cache_size = cache_size
+        self._records = OrderedDict()
+        self._dirty = set()
+        self._wakeup = asyncio.Event()
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny,
+        ))
+
+    async def _record(self, key: StorageKey):
+        skey = self._key(key)
+        record = self._records.get(skey)
+        if record is not None:
+            self._records.move_to_end(skey)
+            return skey, record
+        async with SessionLocal() as session:
+            row = await session.get(FsmState, skey)
+        loaded = [row.state, json.loads(row.data)] if row else [None, {}]
+        # Пока читали с диска, запись могла появиться в памяти — она новее
+        record = self._records.setdefault(skey, loaded)
+        self._evict()
+        return skey, record
+
+    def _evict(self):
+        # Выгружаем только уже сохранённые записи
+        while len(self._records) > self.cache_size:
+            for skey in self._records:
+                if skey not in self._dirty:
+                    del self._records[skey]
+                    break
+            else:
+                return
+
+    def _mark_dirty(self, skey: str):
+        self._dirty.add(skey)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if len(self._dirty) >= self.flush_batch:
+            self._wakeup.set()
+
+    async def set_state(self, key: StorageKey, state=None):
+        skey, record = await self._record(key)
+        record[0] = state.state if isinstance(state, State) else state
+        self._mark_dirty(skey)
+
+    async def get_state(self, key: StorageKey):
+        _, record = await self._record(key)
+        return record[0]
+
+    async def set_data(self, key: StorageKey, data):
+        skey, record = await self._record(key)
+        record[1] = dict(data)
+        self._mark_dirty(skey)
+
+    async def get_data(self, key: StorageKey):
+        _, record = await self._record(key)
+        return record[1].copy()
+
+    async def update_data(self, key: StorageKey, data):
+        skey, record = await self._record(key)
+        record[1].update(data)
+        self._mark_dirty(skey)
+        return record[1].copy()
+
+    async def _flush_loop(self):
+        while self._dirty:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            keys, self._dirty = self._dirty, set()
+            rows = [
+                {"key": skey, "state": self._records[skey][0],
+                 "data": json.dumps(self._records[skey][1], ensure_ascii=False, default=str), "updated_at": now}
+                for skey in keys
+            ]
+            stmt = insert(FsmState)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[FsmState.key],
+                set_={"state": stmt.excluded.state, "data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at},
+            )
+            try:
+                await db_writer.submit(lambda session: session.execute(stmt, rows))
+            except asyncio.CancelledError:
+                self._dirty |= keys
+                raise
+            except Exception as e:
+                logger.warning("fsm flush error keys=%d error=%r", len(keys), e)
+                self._dirty |= keys
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+# config.py требует токен при импорте; тестам настоящий не нужен
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
@@ -0,0 +1,95 @@
+import time
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from kinopoisk import KinopoiskClient
+from ratelimit import ApiBudget, QuotaExceeded, INTERACTIVE, BACKGROUND
+
+
+def _budget(rate=100, burst=10, daily_limit=100):
+    budget = ApiBudget(rate=rate, burst=burst, daily_limit=daily_limit)
+    # День уже «прочитан» — без обращения к таблице квот
+    budget.quota.day = budget.quota.today()
+    return budget
+
+
+async def _server(statuses, retry_after="1"):
+    # Отвечает по очереди статусами из statuses, дальше — 200
+    hits = []
+
+    async def movie(request):
+        hits.append(request.path)
+        status = statuses[len(hits) - 1] if len(hits) <= len(statuses) else 200
+        if status == 200:
+            return web.json_response({"id": 326, "name": "Побег из Шоушенка"})
+        return web.Response(status=status, headers={"Retry-After": retry_after} if status == 429 else {})
+
+    app = web.Application()
+    app.router.add_get("/v1.4/movie/{id}", movie)
+    server = TestServer(app)
+    await server.start_server()
+    return server, hits
+
+
+def _run(statuses, budget, **client_options):
+    async def run():
+        server, hits = await _server(statuses)
+        client = KinopoiskClient(budget=budget, **client_options)
+        try:
+            started = time.monotonic()
+            result = await client.get_json(str(server.make_url("/v1.4/movie/326")))
+            return result, hits, time.monotonic() - started
+        finally:
+            if client._session is not None:
+                await client._session.close()
+            await server.close()
+
+    return asyncio.run(run())
+
+
+def test_retries_429_and_spends_quota_per_attempt():
+    budget = _budget()
+    result, hits, _ = _run([429, 503], budget, backoff_max=0.01)
+    assert result["name"] == "Побег из Шоушенка"
+    assert len(hits) == 3
+    assert budget.quota.used == 3
+
+
+def test_429_penalizes_bucket():
+    # Retry-After урезается до backoff_max=0.2 с, штраф уводит полное ведро на 0.2 с * rate в минус:
+    # за паузу оно только возвращается к нулю, и повтор ждёт ещё токен (1 / rate)
+    budget = _budget(rate=10)
+    result, hits, elapsed = _run([429], budget, backoff_max=0.2)
+    assert result is not None and len(hits) == 2
+    assert elapsed >= 0.28
+    assert budget.bucket.tokens < 1
+
+
+def test_gives_up_after_retries():
+    budget = _budget()
+    result, hits, _ = _run([429] * 10, budget, retries=2, backoff_max=0.01)
+    assert result is None
+    assert len(hits) == 3
+
+
+def test_exhausted_quota_stops_before_request():
+    budget = _budget(daily_limit=8)
+    budget.quota.used = 8
+    with pytest.raises(QuotaExceeded):
+        _run([], budget)
+
+
+def test_background_leaves_reserve_for_users():
+    async def run():
+        budget = _budget(daily_limit=20)
+        budget.quota.used = 15
+        with pytest.raises(QuotaExceeded):
+            await budget.acquire(BACKGROUND)
+        await budget.acquire(INTERACTIVE)
+        assert not await budget.nearly_exhausted()
+        budget.quota.used = 18
+        # Ниже low_watermark бот сначала отдаёт устаревший кэш
+        assert await budget.nearly_exhausted()
+
+    asyncio.run(run())
@@ -0,0 +1,96 @@
+import shutil
+import sqlite3
+import asyncio
+from sqlalchemy.ext.asyncio import create_async_engine
+from conftest import ROOT
+from migrations import migrate, SCHEMA_VERSION
+from services import _fts_query
+
+LEGACY_ROWS = [
+    # Старая версия позволяла добавить один фильм в профиль несколько раз, kinopoisk_id не хранился
+    ("Матрица", 1999, "фантастика", 1, "Евгеша", 9, None),
+    ("Матрица", 1999, "фантастика", 0, "Евгеша", None, "пересмотреть"),
+    ("МАТРИЦА", 1999, "фантастика", 0, "Вандронович", None, None),
+    ("Матрица", 2021, "фантастика", 0, "Вандронович", None, None),
+    ("Крёстный отец", 1972, "драма", 1, "Евгеша", 10, None),
+]
+
+
+def _legacy_db(tmp_path):
+    path = tmp_path / "films.db"
+    shutil.copy(ROOT / "films.db", path)
+    with sqlite3.connect(path) as db:
+        db.executemany(
+            "INSERT INTO films (title, year, genre, watched, profile, rating_user, comment_user) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            LEGACY_ROWS,
+        )
+    return path
+
+
+def _migrate(path):
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        try:
+            await migrate(engine)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+
+def test_legacy_duplicates_merge_into_one_entry(tmp_path):
+    path = _legacy_db(tmp_path)
+    with sqlite3.connect(path) as db:
+        first_id = db.execute("SELECT MIN(id) FROM films WHERE title = 'Матрица' AND profile = 'Евгеша'").fetchone()[0]
+    _migrate(path)
+    with sqlite3.connect(path) as db:
+        assert db.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+        entries = db.execute(
+            "SELECT user_films.id, watched, rating_user, comment_user FROM user_films "
+            "JOIN films ON films.id = user_films.film_id JOIN profiles USING (user_id) "
+            "WHERE profiles.name = 'Евгеша' AND films.year = 1999 AND films.title = 'Матрица'"
+        ).fetchall()
+        assert entries == [(first_id, 1, 9, "пересмотреть")]
+        # Оба профиля ссылаются на один фильм каталога, фильм 2021 года — отдельный
+        assert db.execute("SELECT COUNT(*) FROM films WHERE year = 1999 AND title IN ('Матрица', 'МАТРИЦА')").fetchone()[0] == 1
+        assert db.execute("SELECT COUNT(DISTINCT film_id) FROM user_films").fetchone()[0] == db.execute("SELECT COUNT(*) FROM films").fetchone()[0]
+        assert db.execute("SELECT COUNT(*) FROM films WHERE year = 2021").fetchone()[0] == 1
+        assert db.execute("SELECT COUNT(*) FROM films_fts").fetchone()[0] == db.execute("SELECT COUNT(*) FROM films").fetchone()[0]
+
+
+def test_migrate_is_idempotent(tmp_path):
+    path = _legacy_db(tmp_path)
+    _migrate(path)
+    _migrate(path)
+    with sqlite3.connect(path) as db:
+        assert db.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+
+
+def _search(db, query):
+    return [title for title, in db.execute(
+        "SELECT films.title FROM films_fts JOIN films ON films.id = films_fts.rowid WHERE films_fts MATCH ?",
+        (_fts_query(query),),
+    )]
+
+
+def test_fts_folds_yo_after_migration(tmp_path):
+    path = _legacy_db(tmp_path)
+    _migrate(path)
+    with sqlite3.connect(path) as db:
+        assert _search(db, "крестный") == ["Крёстный отец"]
+        assert _search(db, "крёстный") == ["Крёстный отец"]
+        db.execute("INSERT INTO films_fts(films_fts) VALUES ('integrity-check')")
+
+
+def test_fts_triggers_fold_yo_on_fresh_db(tmp_path):
+    path = tmp_path / "fresh.db"
+    _migrate(path)
+    with sqlite3.connect(path) as db:
+        film_id = db.execute("INSERT INTO films (title, year) VALUES ('Ёлки', 2010)").lastrowid
+        assert _search(db, "елки") == ["Ёлки"]
+        db.execute("UPDATE films SET title = 'Зелёная миля' WHERE id = ?", (film_id,))
+        assert _search(db, "елки") == []
+        assert _search(db, "зеленая") == ["Зелёная миля"]
+        db.execute("DELETE FROM films WHERE id = ?", (film_id,))
+        assert _search(db, "зеленая") == []
+        db.execute("INSERT INTO films_fts(films_fts) VALUES ('integrity-check')")
@@ -0,0 +1,78 @@
+import asyncio
+import pytest
+from ratelimit import TokenBucket, DailyQuota, QuotaExceeded, INTERACTIVE, BACKGROUND
+from cache import SingleFlight
+
+
+def test_interactive_caller_raises_background_flight():
+    async def run():
+        bucket = TokenBucket(rate=20, capacity=1)
+        bucket.tokens = 0
+        flight = SingleFlight()
+        order = []
+
+        async def fetch(name, priority):
+            await bucket.acquire(priority)
+            order.append(name)
+            return name
+
+        prefetch = [asyncio.create_task(flight.do(("movie", i), fetch, i, priority=BACKGROUND)) for i in range(4)]
+        await asyncio.sleep(0.01)
+        # Пользователь открыл фильм, который префетч ещё не успел загрузить
+        assert await flight.do(("movie", 3), fetch, 3, priority=INTERACTIVE) == 3
+        assert order == [3]
+        await asyncio.gather(*prefetch)
+        assert sorted(order) == [0, 1, 2, 3]
+
+    asyncio.run(run())
+
+
+def test_background_yields_to_interactive():
+    async def run():
+        bucket = TokenBucket(rate=20, capacity=1)
+        bucket.tokens = 0
+        order = []
+
+        async def take(name, priority):
+            await bucket.acquire(priority)
+            order.append(name)
+
+        background = asyncio.create_task(take("background", BACKGROUND))
+        await asyncio.sleep(0.01)
+        await take("interactive", INTERACTIVE)
+        await background
+        assert order == ["interactive", "background"]
+
+    asyncio.run(run())
+
+
+def test_background_does_not_touch_reserve():
+    async def run():
+        quota = DailyQuota(limit=8, background_reserve=0.25, utc_offset=3)
+        quota.day = quota.today()
+        quota.used = 6
+        with pytest.raises(QuotaExceeded):
+            await quota.consume(BACKGROUND)
+        await quota.consume(INTERACTIVE)
+        assert quota.remaining == 1
+
+    asyncio.run(run())
+
+
+def test_prefetch_skipped_near_reserve(monkeypatch):
+    import services
+    from ratelimit import api_budget
+
+    calls = []
+
+    async def details(film_id, priority=INTERACTIVE):
+        calls.append(film_id)
+
+    monkeypatch.setattr(services, "get_film_details_kinopoisk", details)
+    monkeypatch.setattr(api_budget.quota, "day", api_budget.quota.today())
+    reserve = api_budget.quota.background_reserve
+    monkeypatch.setattr(api_budget.quota, "used", api_budget.quota.limit - reserve - 2)
+    asyncio.run(services.prefetch_film_details([1, 2, 3]))
+    assert calls == []
+    asyncio.run(services.prefetch_film_details([1, 2]))
+    assert sorted(calls) == ["1", "2"]
@@ -0,0 +1,75 @@
+import random
+import asyncio
+from aiogram import Bot, Dispatcher
+from aiohttp.test_utils import TestServer, TestClient
+from webhook import UpdateWorkerPool, create_app
+
+bot = Bot(token="123456:TEST")
+
+
+def _update(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "T"},
+            "text": text,
+        },
+    }
+
+
+async def _client(dispatcher, **pool_options):
+    pool = UpdateWorkerPool(dispatcher, bot, **pool_options)
+    pool.start()
+    client = TestClient(TestServer(create_app(pool, path="/webhook", secret=None)))
+    await client.start_server()
+    return pool, client
+
+
+def test_updates_of_one_chat_keep_order():
+    async def run():
+        dispatcher = Dispatcher()
+        handled = []
+
+        @dispatcher.message()
+        async def record(message):
+            await asyncio.sleep(random.uniform(0, 0.02))
+            handled.append((message.chat.id, int(message.text)))
+
+        pool, client = await _client(dispatcher, workers=4)
+        updates = [_update(n, chat_id, str(n)) for n in range(30) for chat_id in (1, 2, 3)]
+        responses = await asyncio.gather(*(client.post("/webhook", json=update) for update in updates))
+        assert [response.status for response in responses] == [200] * len(updates)
+        await pool.stop(timeout=5)
+        await client.close()
+        for chat_id in (1, 2, 3):
+            assert [n for chat, n in handled if chat == chat_id] == list(range(30))
+
+    asyncio.run(run())
+
+
+def test_full_queue_answers_503():
+    async def run():
+        dispatcher = Dispatcher()
+        release = asyncio.Event()
+        handled = []
+
+        @dispatcher.message()
+        async def record(message):
+            await release.wait()
+            handled.append(message.text)
+
+        pool, client = await _client(dispatcher, workers=1, queue_size=1, enqueue_timeout=0.05)
+        # Первый апдейт занимает воркер, второй ждёт в очереди, третьему места нет
+        assert (await client.post("/webhook", json=_update(1, 1, "a"))).status == 200
+        await asyncio.sleep(0.05)
+        assert (await client.post("/webhook", json=_update(2, 1, "b"))).status == 200
+        assert (await client.post("/webhook", json=_update(3, 1, "c"))).status == 503
+        release.set()
+        await pool.stop(timeout=5)
+        await client.close()
+        assert handled == ["a", "b"]
+
+    asyncio.run(run())
@@ -0,0 +1,141 @@
+import io
+import os
+import re
+import csv
+import json
+from aiogram.types import InputFile
+from cache import normalize_query
+
+IMPORT_MAX_ITEMS = int(os.getenv("IMPORT_MAX_ITEMS", "1000"))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(2 * 1024 * 1024)))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "200"))
+
+# Заголовки колонок в экспортах Letterboxd (Name, Year, Rating 0.5–5, Watched Date),
+# IMDb (Title, Year, Your Rating 1–10, Date Rated) и в простых таблицах
+TITLE_COLUMNS = ("title", "name", "название", "фильм")
+YEAR_COLUMNS = ("year", "год")
+RATING_COLUMNS = ("your rating", "rating", "оценка")
+WATCHED_COLUMNS = ("watched date", "date rated", "watched", "просмотрен")
+
+EXPORT_COLUMNS = ["title", "year", "kinopoisk_id", "genre", "director", "country", "rating", "watched", "rating_user", "comment_user"]
+
+TXT_LINE = re.compile(r"^(?P<title>.+?)\s*(?:[(\[,]\s*(?P<year>(?:18|19|20)\d{2})\s*[)\]]?)?$")
+
+
+def _decode(data: bytes):
+    for encoding in ("utf-8-sig", "cp1251"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="replace")
+
+
+def _year(value):
+    match = re.search(r"(?:18|19|20)\d{2}", value or "")
+    return int(match.group()) if match else None
+
+
+def _column(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def _parse_csv(text: str, all_watched: bool = False):
+    rows = csv.reader(io.StringIO(text))
+    header = [column.strip().lower() for column in next(rows, [])]
+    title = _column(header, TITLE_COLUMNS)
+    if title is None:
+        return None
+    year = _column(header, YEAR_COLUMNS)
+    rating = _column(header, RATING_COLUMNS)
+    watched = _column(header, WATCHED_COLUMNS)
+    # Letterboxd ставит звёзды от 0.5 до 5, переводим в шкалу 1–10
+    scale = 2 if "letterboxd uri" in header else 1
+    items = []
+    for row in rows:
+        if len(row) <= title or not row[title].strip():
+            continue
+        item = {"title": row[title].strip(), "year": _year(row[year]) if year is not None and len(row) > year else None}
+        if rating is not None and len(row) > rating and row[rating].strip():
+            try:
+                item["rating_user"] = min(10, max(1, round(float(row[rating].replace(",", ".")) * scale)))
+            except ValueError:
+                pass
+        item["watched"] = all_watched or bool(item.get("rating_user")) or (watched is not None and len(row) > watched and bool(row[watched].strip()))
+        items.append(item)
+    return items
+
+
+def _parse_txt(text: str):
+    items = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        match = TXT_LINE.match(line)
+        items.append({"title": match.group("title"), "year": int(match.group("year")) if match.group("year") else None, "watched": False})
+    return items
+
+
+def parse_import_file(filename: str, data: bytes):
+    text = _decode(data)
+    items = None
+    filename = (filename or "").lower()
+    if filename.endswith(".csv"):
+        # watched.csv из Letterboxd — всё просмотрено, хотя отдельной колонки нет
+        items = _parse_csv(text, all_watched="watched" in filename)
+    if items is None:
+        items = _parse_txt(text)
+    # Повторы внутри файла (одно название и год) схлопываем сразу, до запросов к API
+    unique = {}
+    for item in items:
+        unique.setdefault((normalize_query(item["title"]), item["year"]), item)
+    return list(unique.values())[:IMPORT_MAX_ITEMS]
+
+
+def _export_row(film):
+    return {column: getattr(film, column) for column in EXPORT_COLUMNS}
+
+
+async def export_chunks(films, fmt: str):
+    # films — асинхронный итератор (services.iter_films): в памяти только текущая порция
+    if fmt == "json":
+        chunk, count = ["["], 0
+        async for film in films:
+            chunk.append(("\n" if not count else ",\n") + json.dumps(_export_row(film), ensure_ascii=False))
+            count += 1
+            if count % EXPORT_BATCH_SIZE == 0:
+                yield "".join(chunk).encode()
+                chunk = []
+        chunk.append("\n]\n")
+        yield "".join(chunk).encode()
+        return
+    buffer = io.StringIO()
+    # BOM — чтобы Excel открыл кириллицу без танцев с кодировкой
+    buffer.write("\ufeff")
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+    writer.writeheader()
+    count = 0
+    async for film in films:
+        writer.writerow(_export_row(film))
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+class ExportFile(InputFile):
+    # Файл для send_document, который генерируется по ходу отправки
+    def __init__(self, films, fmt: str, filename: str):
+        super().__init__(filename=filename)
+        self.films = films
+        self.fmt = fmt
+
+    async def read(self, bot):
+        async for chunk in export_chunks(self.films, self.fmt):
+            yield chunk
@@ -0,0 +1,127 @@
+import signal
+import asyncio
+import logging
+from contextlib import suppress
+from aiohttp import web
+from aiogram.types import Update
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT,
+    WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_ENQUEUE_TIMEOUT, SHUTDOWN_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def chat_key(update: Update):
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user is not None else update.update_id
+
+
+class UpdateWorkerPool:
+    # Фиксированное число воркеров, у каждого своя ограниченная очередь.
+    # Апдейты одного чата всегда попадают в одну очередь и обрабатываются
+    # строго по порядку, разные чаты — параллельно.
+    def __init__(self, dispatcher, bot, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE,
+                 enqueue_timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.enqueue_timeout = enqueue_timeout
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.queue_size = queue_size
+        self._workers = []
+        self._inline = set()
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(queue)) for queue in self.queues]
+
+    async def submit(self, update: Update):
+        if update.inline_query is not None:
+            # Inline-запросы идут мимо очередей: каждый новый символ отменяет поиск по
+            # предыдущему (bot.inline_search), а в очереди чата они ждали бы друг друга
+            if len(self._inline) >= self.queue_size:
+                return False
+            task = asyncio.create_task(self._process(update))
+            self._inline.add(task)
+            task.add_done_callback(self._inline.discard)
+            return True
+        queue = self.queues[hash(chat_key(update)) % len(self.queues)]
+        try:
+            await asyncio.wait_for(queue.put(update), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def _process(self, update: Update):
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception:
+            logger.exception("update processing failed update_id=%s", update.update_id)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self._process(update)
+            finally:
+                queue.task_done()
+
+    def pending(self):
+        return sum(queue.qsize() for queue in self.queues) + len(self._inline)
+
+    async def stop(self, timeout=None):
+        inline = asyncio.gather(*self._inline, return_exceptions=True)
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.gather(inline, *(queue.join() for queue in self.queues)), timeout)
+        for task in [*self._workers, *self._inline]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._inline, return_exceptions=True)
+        self._workers = []
+
+
+def create_app(pool: UpdateWorkerPool, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+    async def handle_update(request: web.Request):
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=401)
+        update = Update.model_validate(await request.json(), context={"bot": pool.bot})
+        # Очередь переполнена: 503, Telegram повторит доставку позже
+        if not await pool.submit(update):
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def run_webhook(dispatcher, bot, stop=None):
+    # stop — событие, по которому сервер останавливается (сигнал или перезапуск из меню)
+    pool = UpdateWorkerPool(dispatcher, bot)
+    app = create_app(pool)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    await dispatcher.emit_startup(bot=bot)
+    pool.start()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        await bot.set_webhook(
+            f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+        await stop.wait()
+    finally:
+        # Сначала перестаём принимать апдейты, потом дорабатываем очередь
+        await runner.cleanup()
+        await pool.stop(timeout=SHUTDOWN_TIMEOUT)
+        await dispatcher.emit_shutdown(bot=bot)
+        await bot.session.close()
@@ -0,0 +1,108 @@
+import os
+import asyncio
+import logging
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "200"))
+# Сколько подождать попутных записей перед коммитом (0 — брать только то, что уже в очереди)
+WRITE_BATCH_DELAY = float(os.getenv("WRITE_BATCH_DELAY", "0"))
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("database write failed error=%r", future.exception())
+
+
+class DatabaseWriter:
+    # Все изменения базы идут через одну задачу: записи, накопившиеся в очереди,
+    # коммитятся одной транзакцией. Читатели работают через SessionLocal параллельно.
+    # Операция — async-функция от сессии; коммитит её сам writer.
+    def __init__(self, session_factory=SessionLocal, batch_size=WRITE_BATCH_SIZE, batch_delay=WRITE_BATCH_DELAY):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue = asyncio.Queue()
+        self._task = None
+        self.batches = 0
+        self.writes = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, operation):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, future))
+        self.start()
+        return await future
+
+    def submit_nowait(self, operation):
+        # Для записей, результат которых вызывающему не нужен (кэш, статистика)
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_failure)
+        self._queue.put_nowait((operation, future))
+        self.start()
+        return future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            if self.batch_delay:
+                await asyncio.sleep(self.batch_delay)
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await self._commit(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _commit(self, batch):
+        batch = [(operation, future) for operation, future in batch if not future.cancelled()]
+        if not batch:
+            return
+        results = []
+        try:
+            async with self.session_factory() as session:
+                for operation, _ in batch:
+                    results.append(await operation(session))
+                await session.commit()
+        except Exception as e:
+            # Одна операция сломала общую транзакцию: повторяем каждую отдельно,
+            # чтобы ошибка досталась только её автору
+            if len(batch) > 1:
+                for item in batch:
+                    await self._commit([item])
+            elif not batch[0][1].done():
+                batch[0][1].set_exception(e)
+            return
+        self.batches += 1
+        self.writes += len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    async def flush(self):
+        if self._task is not None and not self._task.done():
+            await self._queue.join()
+
+    async def close(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+db_writer = DatabaseWriter()